@@ -18,7 +18,6 @@
 # pylint: disable=too-many-nested-blocks, too-many-public-methods, too-many-instance-attributes, too-many-statements
 # pylint: disable=invalid-name, missing-docstring, bad-continuation
 
-import traceback
 import sys
 import re
 import subprocess
@@ -27,13 +26,9 @@ import contextlib
 import shutil
 import stat
 import errno
-import ctypes
 from itertools import chain, izip, repeat
 from urlparse import urlparse
-import urllib2
-import zipfile
 import argparse
-import tempfile
 
 
 # Application version
@@ -59,6 +54,7 @@ ignores = [
     "BUILD",
     ".build",
     ".export",
+    ".mbed-trash",
 
     # Online IDE caches
     ".msub",
@@ -96,19 +92,19 @@ ignores = [
     ]
 
 # reference to local (unpublished) repo - dir#rev
-regex_local_ref = r'^([\w.+-][\w./+-]*?)/?(?:#(.*))?$'
+regex_local_ref = re.compile(r'^([\w.+-][\w./+-]*?)/?(?:#(.*))?$')
 # reference to repo - url#rev
-regex_url_ref = r'^(.*/([\w.+-]+)(?:\.\w+)?)/?(?:#(.*))?$'
+regex_url_ref = re.compile(r'^(.*/([\w.+-]+)(?:\.\w+)?)/?(?:#(.*))?$')
 
 # git url (no #rev)
-regex_git_url = r'^(git\://|ssh\://|https?\://|)(([^/:@]+)(\:([^/:@]+))?@)?([^/:]+)[:/](.+?)(\.git|\/?)$'
+regex_git_url = re.compile(r'^(git\://|ssh\://|https?\://|)(([^/:@]+)(\:([^/:@]+))?@)?([^/:]+)[:/](.+?)(\.git|\/?)$')
 # hg url (no #rev)
-regex_hg_url = r'^(file|ssh|https?)://([^/:]+)/([^/]+)/?([^/]+?)?$'
+regex_hg_url = re.compile(r'^(file|ssh|https?)://([^/:]+)/([^/]+)/?([^/]+?)?$')
 
 # mbed url is subset of hg. mbed doesn't support ssh transport
-regex_mbed_url = r'^(https?)://([\w\-\.]*mbed\.(co\.uk|org|com))/(users|teams)/([\w\-]{1,32})/(repos|code)/([\w\-]+)/?$'
+regex_mbed_url = re.compile(r'^(https?)://([\w\-\.]*mbed\.(co\.uk|org|com))/(users|teams)/([\w\-]{1,32})/(repos|code)/([\w\-]+)/?$')
 # mbed sdk builds url
-regex_build_url = r'^(https?://([\w\-\.]*mbed\.(co\.uk|org|com))/(users|teams)/([\w\-]{1,32})/(repos|code)/([\w\-]+))/builds/?([\w\-]{6,40}|tip)?/?$'
+regex_build_url = re.compile(r'^(https?://([\w\-\.]*mbed\.(co\.uk|org|com))/(users|teams)/([\w\-]{1,32})/(repos|code)/([\w\-]+))/builds/?([\w\-]{6,40}|tip)?/?$')
 
 # base url for all mbed related repos (used as sort of index)
 mbed_base_url = 'https://github.com/ARMmbed'
@@ -124,10 +120,26 @@ verbose = False
 very_verbose = False
 install_requirements = True
 cache_repositories = True
+# seconds to wait for a probe of the SCM that serves a URL (see Repo.detect_scm)
+probe_timeout = 10
 
 # stores current working directory for recursive operations
 cwd_root = ""
 
+# trace events in Chrome trace event format when tracing is enabled (see --trace)
+trace_events = None
+# names of all started processes by executable and verb, e.g. "git fetch" (see --spawn-stats)
+spawned = []
+# durations of child processes when profiling is enabled (see --profile-cli)
+child_waits = None
+profile_file = 'mbed-cli.prof'
+profile_top = 30
+# names of cache hits and, when the metrics log is enabled (see "mbed stats"), the time spent per
+# repository path and the bytes downloaded by clones and updates
+cache_hits = []
+lib_times = None
+downloads = None
+
 
 # Logging and output
 def log(msg):
@@ -169,15 +181,135 @@ def progress():
     sys.stdout.write('\b')
 
 
+# Tracing
+# Records the duration of a block as a complete event. The block can add event arguments to the
+# yielded dict, e.g. the exit code of a process
+@contextlib.contextmanager
+def traced(name, cat, **args):
+    import time
+    start = time.time()
+    try:
+        yield args
+    finally:
+        if trace_events is not None:
+            import thread
+            trace_events.append({'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.get_ident(),
+                                 'ts': int(start * 1000000), 'dur': int((time.time() - start) * 1000000), 'args': args})
+        if child_waits is not None and cat in ['popen', 'pquery']:
+            child_waits.append(time.time() - start)
+
+# Records an instant event, e.g. a cache hit
+def trace(name, cat, **args):
+    if cat == 'cache':
+        cache_hits.append(name)
+    if trace_events is not None:
+        import time
+        import thread
+        trace_events.append({'name': name, 'cat': cat, 'ph': 'i', 's': 't', 'pid': os.getpid(), 'tid': thread.get_ident(),
+                             'ts': int(time.time() * 1000000), 'args': args})
+
+# Records the time spent on a repository for the metrics log
+@contextlib.contextmanager
+def timed_repo(path):
+    import time
+    start = time.time()
+    try:
+        yield
+    finally:
+        if lib_times is not None:
+            lib_times.append((os.path.abspath(path), time.time() - start))
+
+# Records the growth of the repository packs in path as downloaded bytes for the metrics log. Only
+# the pack directories are measured (Git packs, Mercurial changelog and manifest), so large trees
+# aren't walked twice per command
+@contextlib.contextmanager
+def downloading(path):
+    def size():
+        total = 0
+        for pack in [os.path.join('.git', 'objects', 'pack'), os.path.join('.hg', 'store')]:
+            pack_dir = os.path.join(path, pack)
+            try:
+                names = os.listdir(pack_dir)
+            except OSError:
+                continue
+            for name in names:
+                try:
+                    st = os.lstat(os.path.join(pack_dir, name))
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    total += st.st_size
+        return total
+
+    before = size() if downloads is not None else 0
+    try:
+        yield
+    finally:
+        if downloads is not None:
+            downloads.append(max(0, size() - before))
+
+# Walks a directory tree like os.walk() and records the walk in the trace
+def walk(top, name):
+    with traced(name, 'walk', path=top) as event:
+        event['dirs'] = 0
+        for entry in os.walk(top):
+            event['dirs'] += 1
+            yield entry
+
+# Names a process in the trace by its executable and first argument, e.g. "git fetch"
+def trace_name(command):
+    rest = [c for c in command[1:] if not c.startswith('-')]
+    return os.path.basename(command[0]) + (' ' + os.path.basename(rest[0]) if rest else '')
+
+# Profiles a command with cProfile and writes the statistics to a pstats file. Time spent waiting on
+# child processes is added as the pseudo-entry "<child processes>"
+def profile_cli(path, func, *args):
+    global child_waits
+    import cProfile
+    import pstats
+    child_waits = []
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        waited = sum(child_waits)
+        stats.stats[('~', 0, '<child processes>')] = (len(child_waits), len(child_waits), waited, waited, {})
+        stats.total_calls += len(child_waits)
+        stats.prim_calls += len(child_waits)
+        try:
+            stats.dump_stats(path)
+        except (IOError, OSError):
+            warning("Unable to write profile file \"%s\"" % path)
+        sys.stderr.write("[mbed] Profile written to \"%s\". Waited %.3fs on %d child processes (summed over threads)\n" % (path, waited, len(child_waits)))
+        stats.sort_stats('cumulative').print_stats(profile_top)
+
+# Started processes of the command by executable and verb
+def spawn_stats(command):
+    counts = {}
+    for name in spawned:
+        counts[name] = counts.get(name, 0) + 1
+    return {'command': command, 'total': len(spawned), 'processes': counts}
+
+def write_trace(path, command):
+    import json
+    try:
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': command}}] + trace_events,
+                       'displayTimeUnit': 'ms'}, f)
+    except (IOError, OSError):
+        warning("Unable to write trace file \"%s\"" % path)
+
+
 # Process execution
 class ProcessException(Exception):
     pass
 
-def popen(command, stdin=None, **kwargs):
-    # print for debugging
-    info('Exec "'+' '.join(command)+'" in '+os.getcwd())
+# Starts a process and counts it in the spawn statistics. Callers record it in the trace
+def pstart(command, **kwargs):
+    spawned.append(trace_name(command))
     try:
-        proc = subprocess.Popen(command, **kwargs)
+        return subprocess.Popen(command, **kwargs)
     except OSError as e:
         if e[0] == errno.ENOENT:
             error(
@@ -186,23 +318,23 @@ def popen(command, stdin=None, **kwargs):
         else:
             raise e
 
-    if proc.wait() != 0:
+def popen(command, stdin=None, **kwargs):
+    # print for debugging
+    info('Exec "'+' '.join(command)+'" in '+os.getcwd())
+    with traced(trace_name(command), 'popen', command=' '.join(command), cwd=os.getcwd()) as event:
+        proc = pstart(command, **kwargs)
+        event['exit_code'] = proc.wait()
+    if proc.returncode != 0:
         raise ProcessException(proc.returncode, command[0], ' '.join(command), os.getcwd())
 
 def pquery(command, stdin=None, **kwargs):
     if very_verbose:
         info('Query "'+' '.join(command)+'" in '+os.getcwd())
-    try:
-        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
-    except OSError as e:
-        if e[0] == errno.ENOENT:
-            error(
-                "Could not execute \"%s\".\n"
-                "Please verify that it's installed and accessible from your current path by executing \"%s\".\n" % (command[0], command[0]), e[0])
-        else:
-            raise e
-
-    stdout, _ = proc.communicate(stdin)
+    with traced(trace_name(command), 'pquery', command=' '.join(command), cwd=os.getcwd()) as event:
+        proc = pstart(command, stdin=subprocess.PIPE if stdin is not None else None,
+                      stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+        stdout, stderr = proc.communicate(stdin)
+        event.update(exit_code=proc.returncode, stdout_bytes=len(stdout or ''), stderr_bytes=len(stderr or ''))
 
     if very_verbose:
         log(str(stdout).strip()+"\n")
@@ -212,6 +344,149 @@ def pquery(command, stdin=None, **kwargs):
 
     return stdout
 
+# Runs a quick check, e.g. whether a URL is served by an SCM, without any output or interaction.
+# Returns whether it succeeded within the timeout. The command is killed when it takes longer
+def pprobe(command, timeout=None, **kwargs):
+    import time
+    if very_verbose:
+        info('Probe "'+' '.join(command)+'" in '+os.getcwd())
+    spawned.append(trace_name(command))
+    with traced(trace_name(command), 'probe', command=' '.join(command), cwd=os.getcwd()) as event:
+        try:
+            with open(os.devnull, 'r+') as null:
+                proc = subprocess.Popen(command, stdin=null, stdout=null, stderr=null, **kwargs)
+        except OSError:
+            return False
+
+        deadline = time.time() + (timeout or probe_timeout)
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.02)
+        if proc.returncode is None:
+            info("Probe \"%s\" timed out" % ' '.join(command))
+            proc.kill()
+            proc.wait()
+            event['timeout'] = True
+            return False
+        event['exit_code'] = proc.returncode
+    return proc.returncode == 0
+
+# Runs a command and prefixes every line of its output with the given name. Used for concurrent
+# commands so their interleaved output stays readable. Returns the exit code of the command
+def pprefixed(name, command, **kwargs):
+    info('Exec "'+' '.join(command)+'" in '+os.getcwd())
+    with traced(trace_name(command), 'popen', command=' '.join(command), cwd=os.getcwd(), prefix=name) as event:
+        proc = pstart(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+        output_bytes = 0
+        for line in iter(proc.stdout.readline, ''):
+            output_bytes += len(line)
+            with output_lock:
+                log("[%s] %s" % (name, line if line.endswith('\n') else line + '\n'))
+        event.update(exit_code=proc.wait(), stdout_bytes=output_bytes)
+    return proc.returncode
+
+output_lock = None
+
+# Calls func for every item using at most jobs concurrent threads.
+# Returns a list of (item, result, duration) in the order of the items
+def run_parallel(items, func, jobs=None):
+    import threading
+    import time
+    global output_lock
+    if output_lock is None:
+        output_lock = threading.Lock()
+
+    if not jobs:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+
+    pending = list(enumerate(items))
+    results = [None] * len(pending)
+    queue_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with queue_lock:
+                if not pending:
+                    return
+                idx, item = pending.pop(0)
+            start = time.time()
+            try:
+                result = func(item)
+            except (Exception, SystemExit) as e: # error() raises SystemExit
+                result = e
+            results[idx] = (item, result, time.time() - start)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(jobs, len(pending)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        while t.is_alive(): # join with a timeout so KeyboardInterrupt reaches the main thread
+            t.join(0.2)
+    return results
+
+# Flashes firmware onto several boards concurrently and resets them. Boards that were last
+# flashed with the same image are skipped unless forced. Returns a list of (board, status,
+# duration) where status is 'ok', 'unchanged' or the step that failed: 'flash' or 'reset'
+def flash_boards(boards, fw_file, flash_func, reset_func, jobs=None, force=False):
+    import hashlib
+    with open(fw_file, 'rb') as f:
+        fw_hash = hashlib.sha1(f.read()).hexdigest()
+    flashed = Store('flash').load()
+
+    def flash_one(board):
+        # A board that was re-enumerated since (new mount point or serial port) or reported a
+        # failed flash is flashed again
+        record = {'hash': fw_hash, 'mount': board['mount'], 'serial': board['serial']}
+        if not force and flashed.get(board['id']) == record and not os.path.isfile(os.path.join(board['mount'], 'FAIL.TXT')):
+            trace('flash', 'cache', board=board['id'])
+            return 'unchanged'
+        if not flash_func(board['mount'], fw_file, program_cycle_s=2):
+            return 'flash'
+        if not reset_func(board['serial']):
+            return 'reset'
+        return 'ok'
+
+    results = run_parallel(boards, flash_one, jobs or len(boards))
+
+    flashed = Store('flash').load()
+    for board, status, _ in results:
+        if status == 'ok':
+            flashed[board['id']] = {'hash': fw_hash, 'mount': board['mount'], 'serial': board['serial']}
+        elif status != 'unchanged':
+            flashed.pop(board['id'], None)
+    Store('flash').save(flashed)
+    return results
+
+# Splits tests into at most count groups of similar total duration by assigning the longest
+# tests first to the least loaded group. Tests without a known duration count as the median
+def shard_tests(tests, durations, count):
+    known = sorted(durations[t] for t in tests if t in durations)
+    default = known[len(known) // 2] if known else 1.0
+    groups = [[] for _ in range(count)]
+    loads = [0.0] * count
+    for test in sorted(tests, key=lambda t: (-durations.get(t, default), t)):
+        idx = loads.index(min(loads))
+        groups[idx].append(test)
+        loads[idx] += durations.get(test, default)
+    return [g for g in groups if g]
+
+# Parses the output of the mbed OS tools listings into data for JSON output: tables (e.g. the
+# supported targets and toolchains) into a list of rows keyed by the column titles, and lists
+# of "Name:" and "Path:" lines (e.g. the tests that can be built) into a list of name and path
+def parse_listing(output):
+    rows = [[c.strip() for c in l.strip().strip('|').split('|')] for l in output.splitlines() if l.strip().startswith('|')]
+    if rows:
+        return [dict(zip(rows[0], row)) for row in rows[1:]]
+    items = []
+    for line in output.splitlines():
+        m = re.match(r'^\s*(Name|Path):\s*(.*)$', line)
+        if m and m.group(1) == 'Name':
+            items.append({'name': m.group(2).strip()})
+        elif m and items:
+            items[-1]['path'] = m.group(2).strip()
+    return items
+
 def rmtree_readonly(directory):
     def remove_readonly(func, path, _):
         os.chmod(path, stat.S_IWRITE)
@@ -219,6 +494,49 @@ def rmtree_readonly(directory):
 
     shutil.rmtree(directory, onerror=remove_readonly)
 
+# Replaced and obsolete libraries are moved to a trash directory in the program and deleted in the background
+trash_dir = '.mbed-trash'
+trashed = set()
+
+def trash(directory):
+    import tempfile
+    root = Program(os.path.dirname(os.path.abspath(directory))).path
+    tpath = os.path.join(root, trash_dir)
+    try:
+        if not os.path.isdir(tpath):
+            os.mkdir(tpath)
+            if Repo.isrepo(root):
+                Repo.fromrepo(root).ignore(trash_dir)
+        # A rename is atomic and fast, but only works within the same filesystem
+        os.rename(directory, os.path.join(tempfile.mkdtemp(prefix=os.path.basename(directory) + '.', dir=tpath), os.path.basename(directory)))
+        trashed.add(tpath)
+    except OSError:
+        rmtree_readonly(directory)
+
+# Purges the trash of the current program, including purges interrupted in earlier commands, in a detached process
+def purge_trash():
+    for tpath in sorted(trashed | set([os.path.join(Program(os.getcwd()).path, trash_dir)])):
+        if os.path.isdir(tpath) and os.listdir(tpath):
+            info("Purging deleted libraries in \"%s\" in the background" % tpath)
+            with open(os.devnull, 'w') as null:
+                spawn_mbed(['purge-trash', tpath], stdout=null, stderr=null)
+    trashed.clear()
+
+# Starts mbed CLI in a process that outlives the current command
+def spawn_mbed(args, **kwargs):
+    mbed_path = os.path.abspath(__file__)
+    if mbed_path.endswith('.pyc') and os.path.isfile(mbed_path[:-1]):
+        mbed_path = mbed_path[:-1]
+    if os.name == 'nt':
+        kwargs['creationflags'] = 0x00000008 | 0x00000200 # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['preexec_fn'] = os.setsid
+    command = [python_cmd, '-u', mbed_path] + args
+    with open(os.devnull) as null, traced(trace_name(command), 'spawn', command=' '.join(command), cwd=os.getcwd()) as event:
+        proc = pstart(command, stdin=null, close_fds=True, **kwargs)
+        event['pid'] = proc.pid
+    return proc
+
 
 # Directory navigation
 @contextlib.contextmanager
@@ -258,11 +576,7 @@ class Bld(object):
     default_branch = 'default'
 
     def isurl(url):
-        m_url = re.match(regex_url_ref, url.strip().replace('\\', '/'))
-        if m_url:
-            return re.match(regex_build_url, m_url.group(1))
-        else:
-            return False
+        return ParsedUrl.parse(url).build_url
 
     def init(path):
         if not os.path.exists(path):
@@ -294,6 +608,7 @@ class Bld(object):
         try:
             if not os.path.exists(rev_file):
                 action("Downloading library build \"%s\" (might take a minute)" % rev)
+                import urllib2
                 outfd = open(rev_file, 'wb')
                 inurl = urllib2.urlopen(url)
                 outfd.write(inurl.read())
@@ -306,6 +621,7 @@ class Bld(object):
     def unpack_rev(rev):
         rev_file = os.path.join('.'+Bld.name, '.rev-' + rev + '.zip')
         try:
+            import zipfile
             with zipfile.ZipFile(rev_file) as zf:
                 action("Unpacking library build \"%s\" in \"%s\"" % (rev, os.getcwd()))
                 zf.extractall('.')
@@ -379,11 +695,7 @@ class Hg(object):
     ignore_file = os.path.join('.hg', 'hgignore')
 
     def isurl(url):
-        m_url = re.match(regex_url_ref, url.strip().replace('\\', '/'))
-        if m_url and not re.match(regex_build_url, m_url.group(1)):
-            return re.match(regex_hg_url, m_url.group(1)) or re.match(regex_mbed_url, m_url.group(1))
-        else:
-            return False
+        return ParsedUrl.parse(url).hg_url
 
     def init(path=None):
         popen([hg_cmd, 'init'] + ([path] if path else []) + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
@@ -394,6 +706,13 @@ class Hg(object):
     def clone(url, name=None, depth=None, protocol=None):
         popen([hg_cmd, 'clone', formaturl(url, protocol), name] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
 
+    # Checks quickly whether the URL is served by Mercurial. Local repositories are checked on the filesystem
+    def probe(url):
+        path = url[7:] if url.startswith('file://') else url
+        if os.path.isabs(path) or os.path.isdir(path):
+            return os.path.isdir(os.path.join(path, '.hg'))
+        return pprobe([hg_cmd, 'identify', '--noninteractive', formaturl(url)])
+
     def add(dest):
         info("Adding reference \"%s\"" % dest)
         try:
@@ -512,6 +831,14 @@ class Hg(object):
     def getbranch():
         return pquery([hg_cmd, 'branch']).strip() or ""
 
+    # Gets the files changed in the working directory since a revision, including untracked files
+    def changed(rev):
+        return [f for f in pquery([hg_cmd, 'status', '--rev', rev, '-n']).splitlines() if f]
+
+    # Gets the contents of a file at a revision
+    def show(rev, path):
+        return pquery([hg_cmd, 'cat', '-r', rev, path])
+
     def remoteid(url, rev=None):
         return pquery([hg_cmd, 'id', '--id', url] + (['-r', rev] if rev else [])).strip() or ""
 
@@ -578,13 +905,11 @@ class Git(object):
     name = 'git'
     default_branch = 'master'
     ignore_file = os.path.join('.git', 'info', 'exclude')
+    # ref indexes by Git directory (see refindex)
+    refindexes = {}
 
     def isurl(url):
-        m_url = re.match(regex_url_ref, url.strip().replace('\\', '/'))
-        if m_url and not re.match(regex_build_url, m_url.group(1)) and not re.match(regex_mbed_url, m_url.group(1)):
-            return re.match(regex_git_url, m_url.group(1))
-        else:
-            return False
+        return ParsedUrl.parse(url).git_url
 
     def init(path=None):
         popen([git_cmd, 'init'] + ([path] if path else []) + ([] if very_verbose else ['-q']))
@@ -592,19 +917,22 @@ class Git(object):
     def cleanup():
         info("Cleaning up Git index")
         pquery([git_cmd, 'checkout', '--detach', 'HEAD'] + ([] if very_verbose else ['-q'])) # detach head so local branches are deletable
-        branches = []
-        lines = pquery([git_cmd, 'branch']).strip().splitlines() # fetch all local branches
-        for line in lines:
-            if re.match(r'^\*?\s+\((.+)\)$', line):
-                continue
-            line = re.sub(r'\s+', '', line)
-            branches.append(line)
-
-        for branch in branches: # delete all local branches so the new repo clone is not poluted
-            pquery([git_cmd, 'branch', '-D', branch])
-
-    def clone(url, name=None, depth=None, protocol=None):
-        popen([git_cmd, 'clone', formaturl(url, protocol), name] + (['--depth', depth] if depth else []) + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+        branches = sorted(ref for ref in Git.refindex()['refs'] if ref.startswith('refs/heads/'))
+        if branches: # delete all local branches in one transaction so the new repo clone is not poluted
+            pquery([git_cmd, 'update-ref', '--stdin'], stdin=''.join('delete %s\n' % ref for ref in branches))
+
+    # With a reference repository, objects are copied from it instead of being downloaded
+    def clone(url, name=None, depth=None, protocol=None, reference=None):
+        popen([git_cmd, 'clone', formaturl(url, protocol), name] + (['--depth', depth] if depth else []) +
+              (['--reference', reference, '--dissociate'] if reference else []) + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+
+    # Checks quickly whether the URL is served by Git. Local repositories, including bare ones, are checked on the filesystem
+    def probe(url):
+        path = url[7:] if url.startswith('file://') else url
+        if os.path.isabs(path) or os.path.isdir(path):
+            return (os.path.isdir(os.path.join(path, '.git')) or
+                    (os.path.isfile(os.path.join(path, 'HEAD')) and os.path.isdir(os.path.join(path, 'objects'))))
+        return pprobe([git_cmd, 'ls-remote', formaturl(url), 'HEAD'], env=dict(os.environ, GIT_TERMINAL_PROMPT='0'))
 
     def add(dest):
         info("Adding reference "+dest)
@@ -658,10 +986,11 @@ class Git(object):
         info("Checkout \"%s\" in %s" % (rev, os.path.basename(os.getcwd())))
         branch = None
         refs = Git.getrefs(rev)
+        local_refs = Git.refindex()['refs'] if refs else {}
         for ref in refs: # re-associate with a local or remote branch (rev is the same)
             m = re.match(r'^(.*?)\/(.*?)$', ref)
             if m and m.group(2) != "HEAD": # matches origin/<branch> and isn't HEAD ref
-                if not os.path.exists(os.path.join('.git', 'refs', 'heads', m.group(2))): # okay only if local branch with that name doesn't exist (git will checkout the origin/<branch> in that case)
+                if not 'refs/heads/' + m.group(2) in local_refs: # okay only if local branch with that name doesn't exist (git will checkout the origin/<branch> in that case)
                     branch = m.group(2)
             elif ref != "HEAD":
                 branch = ref # matches local branch and isn't HEAD ref
@@ -774,17 +1103,107 @@ class Git(object):
             branch = "master"
         return branch if branch != "HEAD" else ""
 
+    # Gets the files changed in the working tree since a revision, including untracked files
+    def changed(rev):
+        return [f for f in (pquery([git_cmd, 'diff', '--name-only', rev]).splitlines() +
+                            pquery([git_cmd, 'ls-files', '--others', '--exclude-standard']).splitlines()) if f]
+
+    # Gets the contents of a file at a revision
+    def show(rev, path):
+        return pquery([git_cmd, 'show', '%s:%s' % (rev, path.replace('\\', '/'))])
+
     # Finds refs (local or remote branches). Will match rev if specified
     def getrefs(rev=None, ret_rev=False):
+        index = Git.refindex()
+        if not rev:
+            revs = index['revs'].keys()
+        elif rev in index['revs']:
+            revs = [rev]
+        else:
+            revs = [r for r in index['revs'] if r.startswith(rev)]
+
         result = []
-        lines = pquery([git_cmd, 'show-ref']).strip().splitlines()
-        for line in lines:
-            m = re.match(r'^(.+)\s+(.+)$', line)
-            if m and (not rev or m.group(1).startswith(rev)):
-                if re.match(r'refs\/(heads|remotes)\/', m.group(2)): # exclude tags
-                    result.append(m.group(1) if ret_rev else re.sub(r'refs\/(heads|remotes)\/', '', m.group(2)))
+        for ref, ref_rev in sorted((ref, r) for r in revs for ref in index['revs'][r]):
+            m = re.match(r'refs\/(heads|remotes)\/', ref)
+            if m: # exclude tags
+                result.append(ref_rev if ret_rev else ref[m.end():])
         return result
 
+    # Index of the refs of the repository read from packed-refs and loose refs, instead of running
+    # "git show-ref". Returns {'refs': {ref: rev}, 'revs': {rev: [refs]}}. The index is kept until the
+    # refs change, e.g. by fetch, commit or checkout, which is detected by the modification times of
+    # packed-refs and the ref directories
+    def refindex():
+        gitdir = Git.commondir()
+        packed = os.path.join(gitdir, 'packed-refs')
+        loose = []
+        signature = []
+        for root, dirs, files in os.walk(os.path.join(gitdir, 'refs')):
+            signature.append((root, os.stat(root).st_mtime))
+            for f in files:
+                if not f.endswith('.lock'):
+                    # Refs rewritten in place don't change the directory mtime
+                    st = os.stat(os.path.join(root, f))
+                    signature.append((os.path.join(root, f), st.st_mtime, st.st_size))
+                    loose.append(os.path.join(root, f))
+        if os.path.isfile(packed):
+            signature.append((packed, os.stat(packed).st_mtime, os.stat(packed).st_size))
+
+        cached = Git.refindexes.get(gitdir)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        refs = {}
+        try:
+            with open(packed) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and not line.startswith(('#', '^')):
+                        refs[parts[1]] = parts[0]
+        except (IOError, OSError):
+            pass
+        symbolic = {}
+        for fl in loose:
+            ref = 'refs/' + relpath(os.path.join(gitdir, 'refs'), fl).replace(os.sep, '/')
+            try:
+                with open(fl) as f:
+                    value = f.read().strip()
+            except (IOError, OSError):
+                continue
+            if value.startswith('ref: '):
+                symbolic[ref] = value[5:]
+            elif value:
+                refs[ref] = value
+        for ref, target in symbolic.items():
+            if target in refs:
+                refs[ref] = refs[target]
+
+        revs = {}
+        for ref, rev in refs.items():
+            revs.setdefault(rev, []).append(ref)
+        index = {'refs': refs, 'revs': revs}
+        Git.refindexes[gitdir] = (signature, index)
+        return index
+
+    # Git directory of the repository in the current directory, including worktrees and submodules
+    # where .git is a file pointing to it
+    def gitdir():
+        if os.path.isfile('.git'):
+            with open('.git') as f:
+                m = re.match(r'^gitdir:\s*(.+)$', f.read().strip())
+            if m:
+                return os.path.abspath(m.group(1))
+        return os.path.abspath('.git')
+
+    # Git directory with the refs shared by all worktrees of the repository. HEAD stays per worktree
+    def commondir():
+        gitdir = Git.gitdir()
+        try:
+            with open(os.path.join(gitdir, 'commondir')) as f:
+                return os.path.normpath(os.path.join(gitdir, f.read().strip()))
+        except (IOError, OSError):
+            return gitdir
+
     # Finds branches a rev belongs to
     def revbranches(rev):
         branches = []
@@ -858,9 +1277,8 @@ class Repo(object):
     @classmethod
     def fromurl(cls, url, path=None):
         repo = cls()
-        m_local = re.match(regex_local_ref, url.strip().replace('\\', '/'))
-        m_repo_url = re.match(regex_url_ref, url.strip().replace('\\', '/'))
-        m_bld_url = re.match(regex_build_url, url.strip().replace('\\', '/'))
+        parsed = ParsedUrl.parse(url)
+        m_local, m_repo_url, m_bld_url = parsed.local, parsed.repo, parsed.build
         if m_local:
             repo.name = os.path.basename(path or m_local.group(1))
             repo.path = os.path.abspath(path or os.path.join(os.getcwd(), m_local.group(1)))
@@ -885,6 +1303,7 @@ class Repo(object):
 
         cache_cfg = Global().get_cfg('CACHE', '')
         if cache_repositories and cache_cfg and cache_cfg != 'none' and cache_cfg != 'off' and cache_cfg != 'disabled':
+            import tempfile
             loc = cache_cfg if (cache_cfg and cache_cfg != 'on' and cache_cfg != 'enabled') else None
             repo.cache = loc or os.path.join(tempfile.gettempdir(), 'mbed-repo-cache')
 
@@ -895,10 +1314,8 @@ class Repo(object):
         with open(lib) as f:
             ref = f.read(200)
 
-        m_local = re.match(regex_local_ref, ref.strip().replace('\\', '/'))
-        m_repo_url = re.match(regex_url_ref, ref.strip().replace('\\', '/'))
-        m_bld_url = re.match(regex_build_url, ref.strip().replace('\\', '/'))
-        if not (m_local or m_bld_url or m_repo_url):
+        parsed = ParsedUrl.parse(ref)
+        if not (parsed.local or parsed.build or parsed.repo):
             warning(
                 "File \"%s\" in \"%s\" uses a non-standard .lib file extension, which is not compatible with the mbed build tools.\n" % (os.path.basename(lib), os.path.split(lib)[0]))
             return False
@@ -920,6 +1337,7 @@ class Repo(object):
 
         cache_cfg = Global().get_cfg('CACHE', '')
         if cache_repositories and cache_cfg and cache_cfg != 'none' and cache_cfg != 'off' and cache_cfg != 'disabled':
+            import tempfile
             loc = cache_cfg if (cache_cfg and cache_cfg != 'on' and cache_cfg != 'enabled') else None
             repo.cache = loc or os.path.join(tempfile.gettempdir(), 'mbed-repo-cache')
 
@@ -984,8 +1402,36 @@ class Repo(object):
 
     @classmethod
     def isurl(cls, url):
-        m = re.match(regex_url_ref, url.strip().replace('\\', '/'))
-        return True if m else False
+        return True if ParsedUrl.parse(url).repo else False
+
+    # The SCM that serves a URL. URLs that match more than one SCM or none are probed, unless an
+    # earlier clone recorded the SCM of the URL
+    @classmethod
+    def detect_scm(cls, url):
+        known = Store('scm').load().get(formaturl(url, 'https').rstrip('/'))
+        if known and known[0] in scms:
+            trace('scm', 'cache', url=url, scm=known[0])
+            return scms[known[0]]
+
+        matching = [scm for scm in scms.values() if scm.isurl(url)]
+        if len(matching) == 1:
+            return matching[0]
+        for scm in [scms['git'], scms['hg']]:
+            if (not matching or scm in matching) and scm.probe(url):
+                return scm
+        return None
+
+    # Records the SCM that served a URL. Only the most recent URLs are kept
+    @classmethod
+    def set_scm(cls, url, scm):
+        import time
+        store = Store('scm')
+        known = store.load()
+        key = formaturl(url, 'https').rstrip('/')
+        if known.get(key, [None])[0] == scm.name:
+            return
+        known[key] = [scm.name, time.time()]
+        store.save(dict(sorted(known.items(), key=lambda k: k[1][1])[-1000:]))
 
     @property
     def lib(self):
@@ -1037,14 +1483,14 @@ class Repo(object):
     def __wrap_scm(self, method):
         def __scm_call(*args, **kwargs):
             if self.scm and hasattr(self.scm, method) and callable(getattr(self.scm, method)):
-                with cd(self.path):
+                with cd(self.path), timed_repo(self.path):
                     return getattr(self.scm, method)(*args, **kwargs)
         return __scm_call
 
     def __getattr__(self, attr):
         if attr in ['geturl', 'getrev', 'add', 'remove', 'ignores', 'ignore', 'unignore',
                     'status', 'dirty', 'commit', 'outgoing', 'publish', 'checkout', 'update',
-                    'isdetached']:
+                    'isdetached', 'changed', 'show']:
             wrapper = self.__wrap_scm(attr)
             self.__dict__[attr] = wrapper
             return wrapper
@@ -1060,9 +1506,10 @@ class Repo(object):
         return self.scm.remove(dest, *args, **kwargs)
 
     def clone(self, url, path, rev=None, depth=None, protocol=None, **kwargs):
-        # Sorted so repositories that match urls are attempted first
+        # Sorted so the SCM known to serve the URL is attempted first, then SCMs that match the URL
+        detected = Repo.detect_scm(url)
         sorted_scms = [(scm.isurl(url), scm) for scm in scms.values()]
-        sorted_scms = sorted(sorted_scms, key=lambda (m, _): not m)
+        sorted_scms = sorted(sorted_scms, key=lambda (m, scm): (scm is not detected, not m))
 
         for _, scm in sorted_scms:
             main = True
@@ -1071,21 +1518,29 @@ class Repo(object):
             # Try to clone with cache ref first
             if cache and not os.path.isdir(path):
                 info("Found matching cached repository in \"%s\"" % cache)
+                trace('repository cache', 'cache', url=url, cache=cache)
                 try:
                     if os.path.split(path)[0] and not os.path.isdir(os.path.split(path)[0]):
                         os.makedirs(os.path.split(path)[0])
 
-                    info("Carbon copy from \"%s\" to \"%s\"" % (cache, path))
-                    shutil.copytree(cache, path)
-
-                    with cd(path):
-                        scm.seturl(formaturl(url, protocol))
-                        scm.cleanup()
-                        info("Update cached copy from remote repository")
-                        if not rev:
-                            rev = scm.default_branch
-                        scm.update(rev, True)
-                        main = False
+                    if scm.name == 'git' and Global().get_cfg('CACHE_REFERENCE', '') in ['on', 'enabled']:
+                        # The branches come from the remote, so there's nothing to clean up
+                        info("Clone from remote repository with objects from \"%s\"" % cache)
+                        with timed_repo(path), downloading(path):
+                            scm.clone(url, path, depth=depth, protocol=protocol, reference=cache)
+                    else:
+                        info("Carbon copy from \"%s\" to \"%s\"" % (cache, path))
+                        shutil.copytree(cache, path)
+
+                        with cd(path):
+                            scm.seturl(formaturl(url, protocol))
+                            scm.cleanup()
+                            info("Update cached copy from remote repository")
+                            if not rev:
+                                rev = scm.default_branch
+                            with timed_repo(path), downloading(path):
+                                scm.update(rev, True)
+                    main = False
                 except (ProcessException, IOError):
                     info("Discarding cached repository")
                     if os.path.isdir(path):
@@ -1094,7 +1549,8 @@ class Repo(object):
             # Main clone routine if the clone with cache ref failed (might occur if cache ref is dirty)
             if main:
                 try:
-                    scm.clone(url, path, depth=depth, protocol=protocol, **kwargs)
+                    with timed_repo(path), downloading(path):
+                        scm.clone(url, path, depth=depth, protocol=protocol, **kwargs)
                 except ProcessException:
                     if os.path.isdir(path):
                         rmtree_readonly(path)
@@ -1104,13 +1560,14 @@ class Repo(object):
             self.url = url
             self.path = os.path.abspath(path)
             self.ignores()
+            Repo.set_scm(url, scm)
             self.set_cache(url)
             return True
 
         return False
 
     def getlibs(self):
-        for root, dirs, files in os.walk(self.path):
+        for root, dirs, files in walk(self.path, 'find libraries'):
             dirs[:] = [d for d in dirs  if not d.startswith('.')]
             files[:] = [f for f in files if not f.startswith('.')]
 
@@ -1242,8 +1699,9 @@ class Program(object):
                 "Could not find mbed program in current path \"%s\".\n"
                 "You can fix this by calling \"mbed new .\" in the root of your program." % self.path)
 
-    def get_cfg(self, *args, **kwargs):
-        return Cfg(self.path).get(*args, **kwargs) or Global().get_cfg(*args, **kwargs)
+    # Program config takes precedence over environment variables (MBED_<VAR>) and the global config
+    def get_cfg(self, var, default_val=None):
+        return Cfg(self.path).get(var) or Global().get_cfg(var, default_val)
 
     def set_cfg(self, *args, **kwargs):
         return Cfg(self.path).set(*args, **kwargs)
@@ -1312,10 +1770,34 @@ class Program(object):
                 return os.path.join(path)
         return None
 
+    # Gets a key identifying the requirements file and the Python environment it was checked against
+    def get_requirements_key(self, req_file):
+        import hashlib
+        h = hashlib.sha1()
+        with open(req_file, 'rb') as f:
+            h.update(f.read())
+        h.update(python_cmd)
+        for p in sys.path:
+            if os.path.basename(p) in ['site-packages', 'dist-packages'] and os.path.isdir(p):
+                h.update('%s:%s' % (p, os.stat(p).st_mtime))
+        return h.hexdigest()
+
     def check_requirements(self, show_warning=False):
         req_path = self.get_requirements() or self.path
         req_file = 'requirements.txt'
         missing = []
+        try:
+            req_key = self.get_requirements_key(os.path.join(req_path, req_file))
+        except (IOError, OSError):
+            return
+
+        # Skip enumerating the installed packages if this environment already satisfied the same requirements
+        store = Store('requirements')
+        checked = store.load().get('checked', [])
+        if req_key in checked:
+            trace('requirements', 'cache', file=req_file)
+            return
+
         try:
             with open(os.path.join(req_path, req_file), 'r') as f:
                 import pip
@@ -1330,13 +1812,16 @@ class Program(object):
                         action("Auto-installing missing Python modules...")
                         pquery(['pip', 'install', '-q', '-r', os.path.join(req_path, req_file)])
                         missing = []
+                        req_key = self.get_requirements_key(os.path.join(req_path, req_file))
                     except ProcessException:
                         warning("Unable to auto-install required Python modules.")
 
         except (IOError, ImportError, OSError):
-            pass
+            return
 
-        if missing:
+        if not missing:
+            store.save({'checked': ([req_key] + checked)[:20]})
+        else:
             err = (
                 "-----------------------------------------------------------------\n"
                 "The mbed OS tools in this program require the following Python modules: %s\n"
@@ -1400,6 +1885,128 @@ class Program(object):
             error('The mbed tools were not found in "%s". \nRun `mbed deploy` to install dependencies and tools. ' % self.path, -1)
         return mbed_tools_path
 
+    # Compiler executables wrapped by the compiler cache, relative to the configured toolchain path
+    compiler_cache_execs = {
+        'GCC_ARM': ('', ['arm-none-eabi-gcc', 'arm-none-eabi-g++']),
+        'ARM': ('bin', ['armcc']),
+        'uARM': ('bin', ['armcc']),
+        'IAR': ('bin', ['iccarm']),
+    }
+
+    # Gets the compiler cache executable if the compiler cache is enabled
+    def get_compiler_cache(self):
+        cache_cfg = self.get_cfg('COMPILER_CACHE')
+        if not cache_cfg or cache_cfg in ['none', 'off', 'disabled']:
+            return None
+        if os.name == 'nt':
+            warning("The compiler cache is not supported on Windows.")
+            return None
+
+        from distutils.spawn import find_executable
+        ccache = 'ccache' if cache_cfg in ['on', 'enabled'] else cache_cfg
+        ccache = ccache if os.path.isfile(ccache) else find_executable(ccache)
+        if not ccache:
+            warning("Unable to find the compiler cache \"%s\". Please install ccache or set the path to it via \"mbed config -G COMPILER_CACHE <path>\"." % cache_cfg)
+        return ccache
+
+    # Sets up the compiler cache wrappers for the specified toolchains in the build environment.
+    # The wrappers mirror the toolchain directory, so other tools (linker, archiver) still resolve
+    def setup_compiler_cache(self, env, toolchains):
+        import hashlib
+        ccache = self.get_compiler_cache()
+        if not ccache:
+            return None
+
+        from distutils.spawn import find_executable
+        env['CCACHE_DIR'] = os.path.join(Global().path, 'ccache')
+        if self.get_cfg('COMPILER_CACHE_SIZE'):
+            env['CCACHE_MAXSIZE'] = self.get_cfg('COMPILER_CACHE_SIZE')
+
+        for tc in set(toolchains):
+            if tc not in self.compiler_cache_execs:
+                continue
+            subdir, execs = self.compiler_cache_execs[tc]
+            env_var = 'MBED_%s_PATH' % ('ARM' if tc == 'uARM' else tc)
+            tc_path = env.get(env_var)
+            if not tc_path:
+                # Compiler found through PATH
+                cc = find_executable(execs[0])
+                tc_path = os.path.dirname(cc) if cc else None
+                if tc_path and subdir:
+                    tc_path = os.path.dirname(tc_path)
+            if (not tc_path or not os.path.isdir(os.path.join(tc_path, subdir)) or
+                    not any(os.path.isfile(os.path.join(tc_path, subdir, fl)) for fl in execs)):
+                warning("Unable to find the %s compiler. The compiler cache will not be used for %s." % (tc, tc))
+                continue
+
+            tc_path = os.path.abspath(tc_path)
+            wrap_path = os.path.join(env['CCACHE_DIR'], 'wrappers', '%s-%s' % (tc, hashlib.sha1(tc_path + subdir + ccache).hexdigest()[:10]))
+            if not os.path.isdir(os.path.join(wrap_path, subdir)):
+                tmp_path = '%s.%d.tmp' % (wrap_path, os.getpid())
+                os.makedirs(os.path.join(tmp_path, subdir))
+                for fl in os.listdir(os.path.join(tc_path, subdir)):
+                    if fl in execs:
+                        with open(os.path.join(tmp_path, subdir, fl), 'w') as f:
+                            f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (ccache, os.path.join(tc_path, subdir, fl)))
+                        os.chmod(os.path.join(tmp_path, subdir, fl), 0o755)
+                    else:
+                        os.symlink(os.path.join(tc_path, subdir, fl), os.path.join(tmp_path, subdir, fl))
+                if subdir: # the rest of the toolchain (include, lib, config...) next to the wrapped directory
+                    for fl in os.listdir(tc_path):
+                        if fl != subdir:
+                            os.symlink(os.path.join(tc_path, fl), os.path.join(tmp_path, fl))
+                try:
+                    os.rename(tmp_path, wrap_path)
+                except OSError:
+                    rmtree_readonly(tmp_path) # created concurrently by another build
+            info("Using compiler cache \"%s\" for %s" % (ccache, tc))
+            env[env_var] = wrap_path
+        return ccache
+
+    # Gets the compiler cache hit and miss counters
+    def get_compiler_cache_stats(self, ccache, env):
+        stats = {'hits': 0, 'misses': 0}
+        try:
+            # ccache 4.x
+            for line in pquery([ccache, '--print-stats'], env=env).splitlines():
+                name, _, value = line.partition('\t')
+                if name in ['direct_cache_hit', 'preprocessed_cache_hit']:
+                    stats['hits'] += int(value)
+                elif name == 'cache_miss':
+                    stats['misses'] += int(value)
+        except (ProcessException, ValueError):
+            try:
+                for line in pquery([ccache, '-s'], env=env).splitlines():
+                    m = re.match(r'^cache (hit \((?:direct|preprocessed)\)|miss)\s+(\d+)', line)
+                    if m:
+                        stats['misses' if m.group(1) == 'miss' else 'hits'] += int(m.group(2))
+            except ProcessException:
+                return None
+        return stats
+
+    def report_compiler_cache(self, ccache, env, before):
+        after = self.get_compiler_cache_stats(ccache, env)
+        if before and after:
+            hits = after['hits'] - before['hits']
+            misses = after['misses'] - before['misses']
+            action("Compiler cache: %d hits, %d misses%s" % (hits, misses, (' (%d%% hit rate)' % (100 * hits / (hits + misses))) if hits + misses else ''))
+
+    # Gets a key that changes whenever the build tools or the targets database are modified
+    def get_tools_key(self, tools_dir):
+        import hashlib
+        h = hashlib.sha1()
+        for root, dirs, files in walk(tools_dir, 'tools key'):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for f in sorted(files):
+                if f.endswith('.py') or f.endswith('.json'):
+                    st = os.stat(os.path.join(root, f))
+                    h.update('%s:%s:%s\n' % (relpath(tools_dir, os.path.join(root, f)), st.st_mtime, st.st_size))
+        for fl in [os.path.join(tools_dir, '..', 'targets', 'targets.json'), os.path.join(tools_dir, '..', 'hal', 'targets.json')]:
+            if os.path.isfile(fl):
+                st = os.stat(fl)
+                h.update('%s:%s:%s\n' % (os.path.abspath(fl), st.st_mtime, st.st_size))
+        return h.hexdigest()
+
     def get_env(self):
         env = os.environ.copy()
         env['PYTHONPATH'] = os.path.abspath(self.path)
@@ -1410,6 +2017,259 @@ class Program(object):
 
         return env
 
+    # Gets the build script and its arguments for building an application or a static library
+    def get_build_args(self, orig_path, target, tchain, macros, profile, source, build_path, clean, library, artifact_name, app_config, args):
+        if library:
+            # Compile as a library (current dir is default)
+            if not build_path:
+                build_path = os.path.join(os.path.relpath(self.path, orig_path), self.build_dir, 'libraries', os.path.basename(orig_path), target, tchain)
+        else:
+            # Compile as application (root is default)
+            if not build_path:
+                build_path = os.path.join(os.path.relpath(self.path, orig_path), self.build_dir, target, tchain)
+
+        return ('build.py' if library else 'make.py'), (
+            list(chain.from_iterable(izip(repeat('-D'), macros)))
+            + ['-t', tchain, '-m', target]
+            + list(chain.from_iterable(izip(repeat('--profile'), profile or [])))
+            + list(chain.from_iterable(izip(repeat('--source'), source)))
+            + ['--build', build_path]
+            + (['-c'] if clean else [])
+            + (['--artifact-name', artifact_name] if artifact_name else [])
+            + (['--app-config', app_config] if app_config and not library else [])
+            + (['-v'] if verbose else [])
+            + args)
+
+    # Gets a key for the state of the source trees. Files are identified by path, size and
+    # modification time, and repositories by their checked out revision
+    def get_source_key(self, sources, exclude=None):
+        import hashlib
+        exclude = [os.path.abspath(e) for e in (exclude or [])] + [os.path.join(self.path, self.build_dir)]
+        h = hashlib.sha1()
+        for src in sorted(set(os.path.abspath(s) for s in sources)):
+            for root, dirs, files in walk(src, 'source key'):
+                for d in [d for d in dirs if d.startswith('.')]:
+                    h.update('%s\n' % self.get_scm_state(os.path.join(root, d)))
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.') and os.path.join(root, d) not in exclude)
+                for f in sorted(files):
+                    if f.startswith('.') and f != '.mbedignore':
+                        continue
+                    try:
+                        st = os.stat(os.path.join(root, f))
+                        h.update('%s:%s:%s\n' % (os.path.join(root, f), st.st_mtime, st.st_size))
+                    except OSError:
+                        pass
+        return h.hexdigest()
+
+    # Gets the checked out revision of a repository from its metadata without running the SCM
+    def get_scm_state(self, scm_dir):
+        state = scm_dir
+        try:
+            if os.path.basename(scm_dir) == '.git':
+                with open(os.path.join(scm_dir, 'HEAD')) as f:
+                    head = f.read().strip()
+                state += ':' + head
+                if head.startswith('ref:') and os.path.isfile(os.path.join(scm_dir, head[4:].strip())):
+                    with open(os.path.join(scm_dir, head[4:].strip())) as f:
+                        state += ':' + f.read().strip()
+                elif os.path.isfile(os.path.join(scm_dir, 'packed-refs')):
+                    state += ':%s' % os.stat(os.path.join(scm_dir, 'packed-refs')).st_mtime
+            elif os.path.basename(scm_dir) == '.hg' and os.path.isfile(os.path.join(scm_dir, 'dirstate')):
+                with open(os.path.join(scm_dir, 'dirstate'), 'rb') as f:
+                    state += ':' + f.read(20).encode('hex')
+            elif os.path.basename(scm_dir) == '.bld' and os.path.isfile(os.path.join(scm_dir, 'bldrc')):
+                with open(os.path.join(scm_dir, 'bldrc')) as f:
+                    state += ':' + f.read().strip()
+        except (IOError, OSError):
+            pass
+        return state
+
+    # Gets a key for everything that affects the output of an application build
+    def get_build_key(self, tools_key, target, tchain, macros, profile, source, build_path, artifact_name, app_config, args, env):
+        import hashlib
+        h = hashlib.sha1(tools_key + self.get_source_key(source, [build_path]))
+        h.update(repr([target, tchain, macros, artifact_name, args]))
+        for fl in (profile or []) + ([app_config] if app_config else []):
+            try:
+                with open(fl, 'rb') as f:
+                    h.update(f.read())
+            except (IOError, OSError):
+                h.update(fl)
+        for k in sorted(env.keys()):
+            if k.startswith('MBED_'):
+                h.update('%s=%s\n' % (k, env[k]))
+        return h.hexdigest()
+
+    # Gets the firmware files produced by an application build
+    def get_build_artifacts(self, build_path, artifact_name=None):
+        fw_fbase = os.path.join(build_path, artifact_name or self.name)
+        return [fw_fbase + ext for ext in ['.bin', '.hex', '.elf'] if os.path.isfile(fw_fbase + ext)]
+
+    # Checks whether a previous successful build with the same key left its artifacts untouched
+    def is_build_cached(self, build_path, key):
+        cached = Store('.mbed_build', build_path).load()
+        if cached.get('key') != key or not cached.get('artifacts'):
+            return False
+        for fl, mtime, size in cached['artifacts']:
+            if not os.path.isfile(fl) or os.stat(fl).st_mtime != mtime or os.stat(fl).st_size != size:
+                return False
+        trace('build', 'cache', build_path=build_path)
+        return True
+
+    def set_build_cached(self, build_path, key, artifact_name=None):
+        artifacts = [(fl, os.stat(fl).st_mtime, os.stat(fl).st_size) for fl in self.get_build_artifacts(build_path, artifact_name)]
+        if artifacts:
+            Store('.mbed_build', build_path).save({'key': key, 'artifacts': artifacts})
+
+    # Gets the location of the prebuilt library store if the library cache is enabled
+    def get_lib_cache(self):
+        cache_cfg = self.get_cfg('LIBRARY_CACHE')
+        if not cache_cfg or cache_cfg in ['none', 'off', 'disabled']:
+            return None
+        return os.path.join(Global().path, 'libcache') if cache_cfg in ['on', 'enabled'] else os.path.abspath(cache_cfg)
+
+    # Checks whether a library is pinned to a revision, checked out at exactly that revision
+    # and unmodified, including all of its nested libraries
+    def is_lib_pinned(self, lib):
+        if lib.is_local or lib.is_build or not lib.rev or lib.rev == 'latest' or not Repo.isrepo(lib.path):
+            return False
+        lib_repo = Repo.fromrepo(lib.path)
+        if not lib_repo.rev or not (lib_repo.rev.startswith(lib.rev) or lib.rev.startswith(lib_repo.rev)) or lib_repo.dirty():
+            return False
+        return all(self.is_lib_pinned(l) for l in lib_repo.libs)
+
+    # Gets the libraries that can be built once and reused. mbed OS goes first since the
+    # other libraries are built against it
+    def get_pinned_libs(self):
+        libs = [lib for lib in Repo.fromrepo(self.path).libs if self.is_lib_pinned(lib)]
+        return sorted(libs, key=lambda lib: lib.path != self.get_os_dir())
+
+    # Gets a key for a prebuilt library: its URL and revision, the build settings and the
+    # configuration it is compiled with
+    def get_lib_key(self, lib, target, tchain, macros, profile, app_config, deps_key):
+        import hashlib
+        h = hashlib.sha1(repr([formaturl(lib.url, 'https'), lib.rev, target, tchain, macros, deps_key]))
+        for fl in (profile or []) + [app_config or os.path.join(self.path, 'mbed_app.json')]:
+            try:
+                with open(fl, 'rb') as f:
+                    h.update(f.read())
+            except (IOError, OSError):
+                h.update(fl)
+        return h.hexdigest()
+
+    # Builds the pinned libraries that are missing from the prebuilt library store. Returns
+    # pairs of library path and prebuilt library path for the libraries that can be reused
+    def prepare_cached_libs(self, tools_dir, target, tchain, macros, profile, app_config, env, force=False):
+        cache = self.get_lib_cache()
+        if not cache:
+            return []
+        if not self.tools_support_ignore(tools_dir):
+            info("The mbed OS tools don't support --ignore. Pinned libraries are compiled from source.")
+            return []
+
+        # The libraries are compiled with the configuration of the application
+        if not app_config and os.path.isfile(os.path.join(self.path, 'mbed_app.json')):
+            app_config = os.path.join(self.path, 'mbed_app.json')
+
+        libs = self.get_pinned_libs()
+        os_dir = self.get_os_dir()
+        tools_key = self.get_tools_key(tools_dir)
+        os_key = None
+        result = []
+        for lib in libs:
+            if lib.path == os_dir:
+                deps_key = tools_key
+            else:
+                # Other libraries depend on the state of mbed OS, prebuilt or not
+                if os_key is None:
+                    os_key = self.get_source_key([os_dir]) if os_dir else ''
+                deps_key = tools_key + os_key
+            key = self.get_lib_key(lib, target, tchain, macros, profile, app_config, deps_key)
+            lib_path = os.path.join(cache, key)
+
+            if os.path.isfile(lib_path + '.failed') and not force:
+                info("Library \"%s\" could not be prebuilt for %s/%s before and is compiled from source (use --force to retry)" % (lib.name, target, tchain))
+                continue
+            if not os.path.isdir(lib_path):
+                action("Building library \"%s\" at revision %s for %s/%s" % (lib.name, lib.rev, target, tchain))
+                tmp_path = '%s.%d.tmp' % (lib_path, os.getpid())
+                # mbed OS is left unarchived, like in "mbed compile --library --no-archive --source=mbed-os"
+                script, build_args = self.get_build_args(self.path, target, tchain, macros, profile, [lib.path] + [p for _, p in result],
+                                                         tmp_path, False, True, lib.name, None,
+                                                         (['--no-archive'] if lib.path == os_dir else []) +
+                                                         (['--app-config', app_config] if app_config else []))
+                try:
+                    if not os.path.isdir(cache):
+                        os.makedirs(cache)
+                    popen([python_cmd, '-u', os.path.join(tools_dir, script)] + build_args, env=env)
+                    os.rename(tmp_path, lib_path)
+                    if os.path.isfile(lib_path + '.failed'):
+                        os.remove(lib_path + '.failed')
+                except (ProcessException, OSError):
+                    warning("Unable to prebuild library \"%s\" for %s/%s. It will be compiled from source." % (lib.name, target, tchain))
+                    if os.path.isdir(tmp_path):
+                        rmtree_readonly(tmp_path)
+                    if os.path.isdir(cache):
+                        open(lib_path + '.failed', 'w').close()
+                    continue
+            else:
+                info("Using prebuilt library \"%s\" from \"%s\"" % (lib.name, lib_path))
+                trace('prebuilt library', 'cache', library=lib.name, path=lib_path)
+
+            if lib.path == os_dir:
+                os_key = key
+            result.append((lib.path, lib_path))
+        return result
+
+    # Checks whether the build scripts of the mbed OS tools accept ignore patterns (--ignore)
+    def tools_support_ignore(self, tools_dir):
+        try:
+            with open(os.path.join(tools_dir, 'make.py')) as f:
+                return re.search(r'[\'"]--ignore[\'"]', f.read()) is not None
+        except (IOError, OSError):
+            return False
+
+    # Gets the build arguments that leave directories out of the build. The patterns are relative
+    # to the current directory, where the build scripts run
+    def get_ignore_args(self, paths):
+        if not paths:
+            return []
+        return ['--ignore', ','.join('./%s/*' % os.path.relpath(p).replace('\\', '/') for p in paths)]
+
+    # Gets the list of targets from a comma separated list, e.g. "K64F,NUCLEO_F401RE"
+    def get_targets(self, targets=None):
+        return [self.get_target(t.strip()) for t in targets.split(',') if t.strip()] if targets else [self.get_target()]
+
+    # Gets the list of toolchains from a comma separated list, e.g. "GCC_ARM,ARM"
+    def get_toolchains(self, toolchains=None):
+        return [self.get_toolchain(t.strip()) for t in toolchains.split(',') if t.strip()] if toolchains else [self.get_toolchain()]
+
+    # Reads target and toolchain pairs from a build matrix file
+    def get_matrix(self, matrix_file):
+        builds = []
+        try:
+            with open(matrix_file) as f:
+                for line in f.read().splitlines():
+                    line = line.split('#')[0].strip()
+                    if not line:
+                        continue
+                    m = re.match(r'^([\w-]+)[\s,]+([\w-]+)$', line)
+                    if not m:
+                        error("Invalid line \"%s\" in build matrix file \"%s\". Expected \"TARGET TOOLCHAIN\"." % (line, matrix_file), 1)
+                    builds.append((self.get_target(m.group(1)), m.group(2)))
+        except IOError:
+            error("Unable to read build matrix file \"%s\"" % matrix_file, 1)
+        if not builds:
+            error("The build matrix file \"%s\" doesn't list any targets" % matrix_file, 1)
+        return builds
+
+    def cpu_count(self):
+        try:
+            import multiprocessing
+            return multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            return 1
+
     def get_target(self, target=None):
         target_cfg = self.get_cfg('TARGET')
         target = target if target else target_cfg
@@ -1465,18 +2325,317 @@ class Program(object):
             error("No targets were detected.\nPlease make sure a target board is connected to this system.", 1)
         else:
             action("Detected \"%s\" connected to \"%s\" and using com port \"%s\"" % (targets[0]['name'], targets[0]['mount'], targets[0]['serial']))
-            info = {'msd': targets[0]['mount'], 'port': targets[0]['serial'], 'name': targets[0]['name']}
+            info = {'msd': targets[0]['mount'], 'port': targets[0]['serial'], 'name': targets[0]['name'], 'id': targets[0]['id']}
 
         if info is None:
             error("The detected target doesn't support Mass Storage Device capability (MSD)", 1)
         return info
 
+    # Gets the names of the built tests in a test spec, optionally limited to a comma separated
+    # list of names or wildcard patterns, like the -n option of greentea
+    def get_spec_tests(self, test_spec, tests_by_name=None):
+        import json
+        try:
+            with open(test_spec) as f:
+                spec = json.load(f)
+        except (IOError, OSError, ValueError):
+            error("Unable to read the test spec \"%s\". Please build the tests first." % test_spec, 1)
+        tests = sorted(set(str(t) for build in spec.get('builds', {}).values() for t in build.get('tests', {}).keys()))
+        if tests_by_name:
+            import fnmatch
+            patterns = [n.strip() for n in tests_by_name.split(',') if n.strip()]
+            tests = [t for t in tests if any(fnmatch.fnmatch(t, p) for p in patterns)]
+        return tests
+
+    # Runs a command of the mbed OS tools that only lists information. The output is stored per
+    # command and key, and replayed without running the tools while both are unchanged
+    def run_listing(self, command, key, env, json_output=False):
+        import time
+        import hashlib
+        import json
+        store = Store('listings')
+        listings = store.load()
+        key = hashlib.sha1(repr(command) + key).hexdigest()
+        if key in listings:
+            info("Using the cached output of \"%s\"" % ' '.join(command))
+            trace('listing', 'cache', command=' '.join(command))
+            output = listings[key]['output']
+        else:
+            info('Exec "'+' '.join(command)+'" in '+os.getcwd())
+            with traced(trace_name(command), 'pquery', command=' '.join(command), cwd=os.getcwd()) as event:
+                proc = pstart(command, stdout=subprocess.PIPE, env=env)
+                output, _ = proc.communicate()
+                event.update(exit_code=proc.returncode, stdout_bytes=len(output or ''))
+            if proc.returncode != 0:
+                log(output)
+                raise ProcessException(proc.returncode, command[0], ' '.join(command), os.getcwd())
+            listings[key] = {'output': output, 'time': time.time()}
+            store.save(dict(sorted(listings.items(), key=lambda l: l[1]['time'])[-50:]))
+
+        if json_output:
+            log(json.dumps(parse_listing(output), indent=2, sort_keys=True) + "\n")
+        else:
+            log(output)
+
+    # Gets the files changed in a repository since a revision, including the changes in its
+    # libraries since the library revisions referenced at that revision. A library that can't
+    # be compared is returned as a whole directory
+    def get_changed_files(self, repo, rev):
+        changed = [os.path.join(repo.path, f) for f in repo.changed(rev) or []]
+        for lib in repo.libs:
+            old_rev = None
+            try:
+                old_rev = ParsedUrl.parse(repo.show(rev, relpath(repo.path, lib.lib))).rev
+            except ProcessException:
+                pass # library added since
+            try:
+                if not old_rev or not Repo.isrepo(lib.path):
+                    raise ProcessException(1, None, None, None)
+                changed += self.get_changed_files(Repo.fromrepo(lib.path), old_rev)
+            except ProcessException:
+                info("Unable to compare library \"%s\" with revision %s. All of it is considered changed." % (lib.name, old_rev))
+                changed.append(lib.path)
+        return changed
+
+    test_code_exts = ['.c', '.cpp', '.cc', '.h', '.hpp', '.s', '.S']
+    test_doc_exts = ['.md', '.txt', '.rst', '.png', '.jpg', '.svg']
+
+    # Gets the names of the tests affected by the changes since a revision of the program, or None
+    # if all tests are affected. Tests are affected by changes in their directory and by changes
+    # of headers they include directly or through other headers. Headers are matched by file name,
+    # so more tests may be selected than necessary. Changed sources outside of test directories
+    # may be linked into any test, so they affect all tests
+    def get_affected_tests(self, sources, rev):
+        repo = Repo.fromrepo(self.path)
+        if not repo.scm:
+            error("The --affected-since option requires the program to use source control management.", 1)
+        try:
+            changed = self.get_changed_files(repo, rev)
+        except ProcessException:
+            error("Unable to find the changes since revision \"%s\" in program \"%s\"." % (rev, self.name), 1)
+        changed_files = set()
+        for fl in changed:
+            if os.path.isdir(fl):
+                for root, dirs, files in os.walk(fl):
+                    dirs[:] = [d for d in dirs if not d.startswith('.')]
+                    changed_files.update(os.path.join(root, f) for f in files)
+            else:
+                changed_files.add(os.path.abspath(fl))
+
+        build_dir = os.path.join(self.path, self.build_dir)
+        tests = {}    # test directory -> test name
+        includes = {} # file path -> names of the included files
+        for src in set(os.path.abspath(s) for s in sources):
+            for root, dirs, files in walk(src, 'find tests'):
+                dirs[:] = [d for d in dirs if not d.startswith('.') and os.path.join(root, d) != build_dir]
+                group = os.path.dirname(root)
+                if (os.path.basename(os.path.dirname(group)) == 'TESTS' and
+                        'host_tests' not in [os.path.basename(root), os.path.basename(group)]):
+                    tests[root] = '-'.join(relpath(src, root).replace('\\', '/').split('/')).lower()
+                for f in files:
+                    if os.path.splitext(f)[1] not in self.test_code_exts:
+                        continue
+                    path = os.path.join(root, f)
+                    try:
+                        with open(path) as fd:
+                            includes[path] = set(os.path.basename(i) for i in re.findall(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]', fd.read(), re.MULTILINE))
+                    except (IOError, OSError):
+                        pass
+
+        def test_of(path):
+            d = os.path.dirname(path)
+            while d and d not in tests and os.path.dirname(d) != d:
+                d = os.path.dirname(d)
+            return tests.get(d)
+
+        affected = set()
+        changed_headers = set()
+        for fl in changed_files:
+            name, ext = os.path.splitext(os.path.basename(fl))
+            if test_of(fl):
+                affected.add(test_of(fl))
+            elif not os.path.exists(fl) and 'TESTS' in fl.replace('\\', '/').split('/'):
+                continue # removed test
+            elif ext in self.test_doc_exts or ext in ['.lib', '.bld'] or name + ext in [Cfg.file, '.gitignore', '.hgignore']:
+                continue # library changes are compared above
+            elif ext not in self.test_code_exts:
+                info("\"%s\" changed, which may affect all tests" % fl)
+                return None
+            elif ext in ['.h', '.hpp']:
+                changed_headers.add(name + ext)
+            else:
+                info("\"%s\" changed, which may affect all tests" % fl)
+                return None
+
+        # Headers that include changed headers change too
+        includers = {}
+        for path, names in includes.items():
+            if os.path.splitext(path)[1] in ['.h', '.hpp']:
+                for n in names:
+                    includers.setdefault(n, set()).add(os.path.basename(path))
+        pending = list(changed_headers)
+        while pending:
+            for h in includers.get(pending.pop(), []):
+                if h not in changed_headers:
+                    changed_headers.add(h)
+                    pending.append(h)
+
+        for path, names in includes.items():
+            if names & changed_headers and test_of(path):
+                affected.add(test_of(path))
+        return affected
+
+    # Gets a key per test for its binaries, the target and toolchain and the greentea arguments.
+    # Tests with missing binaries have no key
+    def get_test_keys(self, test_spec, tests, target, tchain, args):
+        import hashlib
+        import json
+        if '--report-json' in args:
+            # The report location doesn't affect the results
+            idx = args.index('--report-json')
+            args = args[:idx] + args[idx + 2:]
+        keys = {}
+        with open(test_spec) as f:
+            spec = json.load(f)
+        for build in spec.get('builds', {}).values():
+            for name, test in build.get('tests', {}).items():
+                name = str(name)
+                if name not in tests:
+                    continue
+                h = hashlib.sha1(repr([name, target, tchain, args]))
+                try:
+                    for binary in test.get('binaries', []):
+                        with open(binary['path'], 'rb') as f:
+                            h.update(hashlib.sha1(f.read()).hexdigest())
+                except (IOError, OSError, KeyError, TypeError):
+                    continue
+                keys[name] = h.hexdigest()
+        return keys
+
+    # Records the tests that passed according to a greentea JSON report
+    def set_tests_passed(self, report_file, keys):
+        import time
+        import json
+        try:
+            with open(report_file) as f:
+                report = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        store = Store('test-results')
+        passed = store.load()
+        for build_tests in report.values():
+            for name, result in build_tests.items():
+                if str(name) in keys and isinstance(result, dict) and result.get('single_test_result') == 'OK':
+                    passed[keys[str(name)]] = time.time()
+        # Keep the most recent results only
+        store.save(dict(sorted(passed.items(), key=lambda p: p[1])[-5000:]))
+
+    # Runs the tests of a test spec split over all connected boards of the target, with one
+    # greentea process per board. The greentea reports are merged into one
+    def run_sharded_tests(self, test_spec, target, tchain, tests_by_name, args, env):
+        import json
+        tests = self.get_spec_tests(test_spec, tests_by_name)
+        if not tests:
+            error("No tests to run were found in \"%s\"." % test_spec, 1)
+        targets = self.get_detected_targets()
+        if targets == False:
+            error("The target detection requires that the 'mbed-ls' python module is installed.\nYou can install mbed-ls by running 'pip install mbed-ls'.", 1)
+        boards = [t for t in targets if t['name'] == target]
+        if not boards:
+            error("No \"%s\" targets were detected.\nPlease make sure the target boards are connected to this system." % target, 1)
+
+        # The merged report goes where the user asked for it, the partial reports next to the test spec
+        report_dir = os.path.dirname(os.path.abspath(test_spec))
+        report_file = os.path.join(report_dir, 'test_report.json')
+        if '--report-json' in args and args.index('--report-json') + 1 < len(args):
+            idx = args.index('--report-json')
+            report_file = args[idx + 1]
+            args = args[:idx] + args[idx + 2:]
+
+        store = Store('test-durations')
+        durations = store.load().get('%s/%s' % (target, tchain), {})
+        shards = zip(boards, shard_tests(tests, durations, len(boards)))
+
+        def run_shard(shard):
+            board, group = shard
+            report = os.path.join(report_dir, 'test_report_%s.json' % board['id'])
+            if os.path.isfile(report):
+                os.remove(report)
+            return pprefixed(board['id'], ['mbedgt', '--test-spec', test_spec, '-n', ','.join(group), '--use-tids', board['id'], '--report-json', report]
+                             + (['-V'] if verbose else [])
+                             + args,
+                             env=env)
+
+        action("Running %d tests on %d \"%s\" targets" % (len(tests), len(shards), target))
+        results = run_parallel(shards, run_shard, len(shards))
+
+        merged = {}
+        for (board, group), code, duration in results:
+            try:
+                with open(os.path.join(report_dir, 'test_report_%s.json' % board['id'])) as f:
+                    for build, build_tests in json.load(f).items():
+                        merged.setdefault(build, {}).update(build_tests)
+            except (IOError, OSError, ValueError, AttributeError):
+                warning("No test report was written for target %s" % board['id'])
+        with open(report_file, 'w') as f:
+            json.dump(merged, f, indent=4)
+
+        for build_tests in merged.values():
+            for name, result in build_tests.items():
+                if isinstance(result, dict) and isinstance(result.get('elapsed_time'), (int, float)):
+                    durations[name] = result['elapsed_time']
+        data = store.load()
+        data['%s/%s' % (target, tchain)] = durations
+        store.save(data)
+
+        action("Test summary (report: \"%s\"):" % report_file)
+        failed = 0
+        for (board, group), code, duration in results:
+            if code != 0:
+                failed += 1
+            log("  %-24s %4d tests  %-16s %8.1fs\n" % (board['id'], len(group), 'OK' if code == 0 else ('FAILED (%s)' % code), duration))
+        if failed:
+            error("Tests failed on %d of %d targets." % (failed, len(results)), 1)
+
+    # Gets the boards to flash: the only connected board, all connected boards of the target
+    # ("all") or the boards in a comma separated list of target IDs or unique ID prefixes
+    def get_flash_boards(self, selection, target):
+        if selection is True:
+            detected = self.detect_target()
+            return [{'id': detected['id'], 'name': detected['name'], 'mount': detected['msd'], 'serial': detected['port']}]
+
+        targets = self.get_detected_targets()
+        if targets == False:
+            error("The target detection requires that the 'mbed-ls' python module is installed.\nYou can install mbed-ls by running 'pip install mbed-ls'.", 1)
+        if selection == 'all':
+            boards = [t for t in targets if t['name'] == target]
+            if not boards:
+                error("No \"%s\" targets were detected.\nPlease make sure the target boards are connected to this system." % target, 1)
+        else:
+            boards = []
+            for tid in [t.strip() for t in selection.split(',') if t.strip()]:
+                matches = [t for t in targets if t['id'].lower().startswith(tid.lower())]
+                if not matches:
+                    error("No target with ID \"%s\" was detected." % tid, 1)
+                elif len(matches) > 1:
+                    error("Multiple targets with an ID starting with \"%s\" were detected." % tid, 1)
+                elif matches[0] not in boards:
+                    boards.append(matches[0])
+            for board in boards:
+                if board['name'] != target:
+                    warning("Flashing \"%s\" firmware onto target \"%s\" (%s)" % (target, board['name'], board['id']))
+        for board in boards:
+            if not board['mount']:
+                error("The target \"%s\" (%s) doesn't support Mass Storage Device capability (MSD)" % (board['name'], board['id']), 1)
+        return boards
+
     def get_detected_targets(self):
         targets = []
         try:
             import mbed_lstools
             oldError = None
             if os.name == 'nt':
+                import ctypes
                 oldError = ctypes.windll.kernel32.SetErrorMode(1) # Disable Windows error box temporarily. note that SEM_FAILCRITICALERRORS = 1
             mbeds = mbed_lstools.create()
             detect_muts_list = mbeds.list_mbeds()
@@ -1494,18 +2653,193 @@ class Program(object):
         return targets
 
 
+# Build server used to keep the mbed OS tools loaded between compiles
+class BuildServer(object):
+    program = None
+    tools_dir = None
+    target = None
+    state = None
+    key = None
+    start_timeout = 60
+    idle_timeout = 3600
+
+    def __init__(self, program, tools_dir, target, env):
+        import hashlib
+        self.program = program
+        self.tools_dir = tools_dir
+        self.target = target
+        self.state = Store('server-' + re.sub(r'[^\w.-]', '_', target), os.path.join(program.path, program.build_dir))
+
+        # Settings are read once when the tools are imported, so they are part of the server identity
+        h = hashlib.sha1(program.get_tools_key(tools_dir))
+        for k in sorted(env.keys()):
+            if k.startswith('MBED_') or k == 'PYTHONPATH':
+                h.update('%s=%s\n' % (k, env[k]))
+        settings = os.path.join(program.path, 'mbed_settings.py')
+        if os.path.isfile(settings):
+            h.update('%s' % os.stat(settings).st_mtime)
+        self.key = h.hexdigest()
+
+    # Sends a request and streams the output of the server to the console. Returns the exit code
+    def request(self, req, state=None):
+        import socket
+        import json
+        state = state or self.state.load()
+        sock = socket.create_connection(('127.0.0.1', state['port']))
+        try:
+            req['token'] = state['token']
+            sock.sendall(json.dumps(req) + '\n')
+            code = None
+            for line in sock.makefile('r'):
+                msg = json.loads(line)
+                if 'out' in msg:
+                    log(msg['out'].encode('utf-8'))
+                    sys.stdout.flush()
+                elif 'exit' in msg:
+                    code = msg['exit']
+            return code
+        finally:
+            sock.close()
+
+    def start(self):
+        import socket
+        state = self.state.load()
+        if state.get('port'):
+            if state.get('key') == self.key:
+                try:
+                    self.request({'ping': True}, state)
+                    return state
+                except (socket.error, ValueError, KeyError):
+                    pass
+            else:
+                action("The mbed OS tools have changed. Restarting the build server for \"%s\"" % self.target)
+                try:
+                    self.request({'shutdown': True}, state)
+                except (socket.error, ValueError, KeyError):
+                    pass
+
+        action("Starting build server for \"%s\"" % self.target)
+        # The state and log live in the build directory of the program, which may not exist yet when --build is used
+        self.program.ignore_build_dir()
+        with open(self.state.path[:-5] + '.log', 'w') as logf:
+            spawn_mbed(['build-server', self.tools_dir, '--key', self.key, '--state', self.state.path],
+                       cwd=self.program.path, env=self.program.get_env(), stdout=logf, stderr=logf)
+
+        import time
+        deadline = time.time() + self.start_timeout
+        while time.time() < deadline:
+            state = self.state.load()
+            if state.get('key') == self.key and state.get('port'):
+                return state
+            time.sleep(0.1)
+        error("Unable to start the build server. See \"%s\" for details." % (self.state.path[:-5] + '.log'), 1)
+
+    def run(self, script, args, env):
+        state = self.start()
+        info('Build server "%s" in %s' % (' '.join([script] + args), os.getcwd()))
+        code = self.request({'script': script, 'args': args, 'cwd': os.getcwd(), 'env': env}, state)
+        if code is None:
+            error("The build server terminated unexpectedly. See \"%s\" for details." % (self.state.path[:-5] + '.log'), 1)
+        if code != 0:
+            raise ProcessException(code, script, ' '.join([script] + args), os.getcwd())
+
+    # Server side. Serves requests one at a time until shut down or idle for too long
+    @classmethod
+    def serve(cls, tools_dir, key, state_path, idle_timeout=None):
+        import socket
+        import binascii
+        import runpy
+        import traceback
+        import json
+
+        state = Store(os.path.basename(state_path)[:-5], os.path.dirname(state_path))
+        token = binascii.hexlify(os.urandom(16))
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        server.settimeout(idle_timeout or cls.idle_timeout)
+        state.save({'pid': os.getpid(), 'port': server.getsockname()[1], 'token': token, 'key': key})
+
+        class Output(object):
+            def __init__(self, conn):
+                self.conn = conn
+            def write(self, data):
+                if isinstance(data, str):
+                    data = data.decode('utf-8', 'replace')
+                self.conn.sendall(json.dumps({'out': data}) + '\n')
+            def flush(self):
+                pass
+            def isatty(self):
+                return False
+
+        sys.path.insert(0, os.getcwd())
+        orig_stdout, orig_stderr, orig_env = sys.stdout, sys.stderr, os.environ.copy()
+        try:
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    break
+                conn.settimeout(None)
+                try:
+                    req = json.loads(conn.makefile('r').readline())
+                    if req.get('token') != token:
+                        continue
+                    if req.get('shutdown'):
+                        break
+                    if req.get('ping'):
+                        continue
+
+                    code = 0
+                    sys.stdout = sys.stderr = Output(conn)
+                    try:
+                        os.chdir(req['cwd'].encode('utf-8'))
+                        os.environ.clear()
+                        os.environ.update((k.encode('utf-8'), v.encode('utf-8')) for k, v in req['env'].items())
+                        sys.argv = [os.path.join(tools_dir, req['script'].encode('utf-8'))] + [a.encode('utf-8') for a in req['args']]
+                        runpy.run_path(sys.argv[0], run_name='__main__')
+                    except SystemExit as e:
+                        if e.code is None or isinstance(e.code, int):
+                            code = e.code or 0
+                        else:
+                            sys.stderr.write('%s\n' % e.code)
+                            code = 1
+                    except Exception:
+                        traceback.print_exc(file=sys.stderr)
+                        code = 1
+                    finally:
+                        sys.stdout, sys.stderr = orig_stdout, orig_stderr
+                        os.environ.clear()
+                        os.environ.update(orig_env)
+                    conn.sendall(json.dumps({'exit': code}) + '\n')
+                except (socket.error, ValueError, KeyError):
+                    pass
+                finally:
+                    conn.close()
+        finally:
+            server.close()
+            if state.load().get('token') == token:
+                os.remove(state.path)
+
+
 # Global class used for global config
 class Global(object):
+    # global config directories that are known to exist
+    created = set()
+
     def __init__(self):
         self.path = os.path.join(os.path.expanduser("~"), '.mbed')
-        if not os.path.exists(self.path):
-            try:
-                os.mkdir(self.path)
-            except (IOError, OSError):
-                pass
+        if self.path not in Global.created:
+            if not os.path.exists(self.path):
+                try:
+                    os.mkdir(self.path)
+                except (IOError, OSError):
+                    pass
+            Global.created.add(self.path)
 
-    def get_cfg(self, *args, **kwargs):
-        return Cfg(self.path).get(*args, **kwargs)
+    # Environment variables MBED_<VAR> override the global config
+    def get_cfg(self, var, default_val=None):
+        return env_cfg(var) or Cfg(self.path).get(var, default_val)
 
     def set_cfg(self, *args, **kwargs):
         return Cfg(self.path).set(*args, **kwargs)
@@ -1513,6 +2847,20 @@ class Global(object):
     def list_cfg(self, *args, **kwargs):
         return Cfg(self.path).list(*args, **kwargs)
 
+# Config value set through the environment variable MBED_<VAR>. The program root can't be set
+def env_cfg(var):
+    if var == 'ROOT':
+        return None
+    return os.environ.get('MBED_' + var) or None
+
+# Get all config var/values pairs set through environment variables
+def env_cfg_list():
+    return dict((k[5:], v) for k, v in os.environ.items() if k.startswith('MBED_') and v and env_cfg(k[5:]))
+
+# Parsed config files by path as (mtime, size, var/value pairs in file order)
+cfg_cache = {}
+cfg_line = re.compile(r'^([\w+-]+)\=(.*)$')
+
 # Cfg classed used for handling the config backend
 class Cfg(object):
     path = None
@@ -1521,6 +2869,31 @@ class Cfg(object):
     def __init__(self, path):
         self.path = path
 
+    # Reads and parses the config file unless it's unchanged since it was parsed last
+    def load(self):
+        fl = os.path.join(self.path, self.file)
+        try:
+            st = os.stat(fl)
+        except OSError:
+            return []
+        cached = cfg_cache.get(fl)
+        if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            return cached[2]
+
+        try:
+            with open(fl) as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError):
+            lines = []
+
+        pairs = []
+        for line in lines:
+            m = cfg_line.match(line)
+            if m:
+                pairs.append((m.group(1), m.group(2)))
+        cfg_cache[fl] = (st.st_mtime, st.st_size, pairs)
+        return pairs
+
     # Sets config value
     def set(self, var, val):
         if not re.match(r'^([\w+-]+)$', var):
@@ -1533,79 +2906,270 @@ class Cfg(object):
         except (IOError, OSError):
             lines = []
 
-        for line in lines:
-            m = re.match(r'^([\w+-]+)\=(.*)$', line)
-            if m and m.group(1) == var:
-                lines.remove(line)
-
+        lines = [line for line in lines if not (cfg_line.match(line) and cfg_line.match(line).group(1) == var)]
         if not val is None:
             lines += [var+"="+val]
 
+        # Written via a temporary file so concurrent readers never see partial writes
+        tmp = '%s.%d.tmp' % (fl, os.getpid())
         try:
-            with open(fl, 'w') as f:
+            with open(tmp, 'w') as f:
                 f.write('\n'.join(lines) + '\n')
+            if os.name == 'nt' and os.path.isfile(fl):
+                os.remove(fl)
+            os.rename(tmp, fl)
         except (IOError, OSError):
             warning("Unable to write config file %s" % fl)
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+        cfg_cache.pop(fl, None)
 
     # Gets config value
     def get(self, var, default_val=None):
-        fl = os.path.join(self.path, self.file)
-        try:
-            with open(fl) as f:
-                lines = f.read().splitlines()
-        except (IOError, OSError):
-            lines = []
-
-        for line in lines:
-            m = re.match(r'^([\w+-]+)\=(.*)$', line)
-            if m and m.group(1) == var:
-                return m.group(2)
+        for k, v in self.load():
+            if k == var:
+                return v
         return default_val
 
     # Get all config var/values pairs
     def list(self):
-        fl = os.path.join(self.path, self.file)
+        return dict((k, v) for k, v in self.load() if k != 'ROOT')
+
+
+# Store class used for persistent caches in the global config directory
+class Store(object):
+    path = None
+
+    def __init__(self, name, path=None):
+        self.path = os.path.join(path or Global().path, name + '.json')
+
+    # Loads the stored data. Missing or corrupted stores are treated as empty
+    def load(self):
+        import json
         try:
-            with open(fl) as f:
-                lines = f.read().splitlines()
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            data = None
+        return data if isinstance(data, dict) else {}
+
+    # Saves data via a temporary file so concurrent readers never see partial writes
+    def save(self, data):
+        import json
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            if os.name == 'nt' and os.path.isfile(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
         except (IOError, OSError):
-            lines = []
+            info("Unable to write cache file %s" % self.path)
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+
+
+# Metrics log of commands (see "mbed stats")
+metrics_file = 'metrics.jsonl'
+metrics_max_size = 4 * 1024 * 1024
 
-        vars = {}
+def metrics_enabled():
+    return Global().get_cfg('METRICS', '').lower() in ['on', 'enabled', 'true']
+
+# Appends a record to the metrics log, which is trimmed to its newer half when it grows too large
+def log_metrics(record):
+    import json
+    path = os.path.join(Global().path, metrics_file)
+    try:
+        with open(path, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+        if os.path.getsize(path) > metrics_max_size:
+            with open(path) as f:
+                lines = f.readlines()
+            with open(path + '.tmp', 'w') as f:
+                f.writelines(lines[len(lines) // 2:])
+            if os.name == 'nt':
+                os.remove(path)
+            os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        info("Unable to write metrics file %s" % path)
+
+    statsd = Global().get_cfg('METRICS_STATSD')
+    if statsd:
+        send_statsd(statsd, record)
+
+def load_metrics():
+    import json
+    records = []
+    try:
+        with open(os.path.join(Global().path, metrics_file)) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    except (IOError, OSError):
+        pass
+    return records
+
+# Sends a record as StatsD metrics over UDP to "host:port"
+def send_statsd(address, record):
+    import socket
+    def metric(name):
+        return re.sub(r'[^\w\-]', '_', name)
+
+    prefix = 'mbed.' + metric(record['command'])
+    lines = ['%s.duration:%d|ms' % (prefix, record['duration'] * 1000),
+             '%s.processes:%d|c' % (prefix, sum(record['processes'].values())),
+             '%s.downloaded:%d|c' % (prefix, record['downloaded']),
+             '%s.status.%d:1|c' % (prefix, record['status'])]
+    lines += ['mbed.cache.%s:%d|c' % (metric(name), hits) for name, hits in sorted(record['cache_hits'].items())]
+    lines += ['%s.library.%s:%d|ms' % (prefix, metric(lib), duration * 1000) for lib, duration in sorted(record['libraries'].items())]
+
+    host, _, port = address.rpartition(':')
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         for line in lines:
-            m = re.match(r'^([\w+-]+)\=(.*)$', line)
-            if m and m.group(1) and m.group(1) != 'ROOT':
-                vars[m.group(1)] = m.group(2)
-        return vars
+            sock.sendto(line, (host or 'localhost', int(port)))
+        sock.close()
+    except (socket.error, ValueError):
+        info("Unable to send metrics to StatsD at %s" % address)
+
+# Builds the metrics record of a finished command. Library times are keyed by their path relative
+# to the outermost repository the command worked on
+def record_metrics(command, duration, status, stats):
+    import time
+    repos = {}
+    for path, seconds in lib_times:
+        repos[path] = repos.get(path, 0) + seconds
+    root = min(repos.keys(), key=len) if repos else None
+    def name(path):
+        return '.' if path == root else (relpath(root, path) if path.startswith(root + os.sep) else path)
+    hits = {}
+    for hit in cache_hits:
+        hits[hit] = hits.get(hit, 0) + 1
+    log_metrics({
+        'time': int(time.time()),
+        'command': command,
+        'status': status,
+        'duration': round(duration, 3),
+        'repositories': len(repos),
+        'libraries': dict((name(path), round(seconds, 3)) for path, seconds in repos.items()),
+        'processes': stats['processes'],
+        'downloaded': sum(downloads),
+        'cache_hits': hits})
+
+# Nearest-rank percentile
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, min(len(values), int(-(-len(values) * p // 100))) - 1)] if values else 0
+
+
+# Parsed repository reference, e.g. "url#rev", "dir#rev" or an mbed library build URL. Every reference
+# is parsed once and kept in a LRU memo, so resolving large trees doesn't match the same strings again
+class ParsedUrl(object):
+    memo = None
+    memo_size = 1024
+
+    @classmethod
+    def parse(cls, url):
+        if cls.memo is None:
+            from collections import OrderedDict
+            cls.memo = OrderedDict()
+        parsed = cls.memo.pop(url, None)
+        if parsed is None:
+            parsed = cls(url)
+            if len(cls.memo) >= cls.memo_size:
+                try:
+                    cls.memo.popitem(last=False)
+                except KeyError:
+                    pass
+        cls.memo[url] = parsed
+        return parsed
+
+    def __init__(self, url):
+        self.raw = url
+        ref = url.strip().replace('\\', '/')
+        # the whole reference as local path, repository URL or library build URL (see Repo.fromurl)
+        self.local = regex_local_ref.match(ref)
+        self.repo = regex_url_ref.match(ref)
+        self.build = regex_build_url.match(ref)
+        # the URL of the reference without revision by SCM (see the isurl() of the SCMs)
+        base = self.repo.group(1) if self.repo else ''
+        self.build_url = regex_build_url.match(base)
+        mbed = regex_mbed_url.match(base) if not self.build_url else None
+        self.hg_url = (regex_hg_url.match(base) or mbed) if not self.build_url else None
+        self.git_url = regex_git_url.match(base) if not self.build_url and not mbed else None
+        self.forms = {}
 
+    @property
+    def scm(self):
+        return 'bld' if self.build_url else ('git' if self.git_url else ('hg' if self.hg_url else None))
 
-def formaturl(url, format="default"):
-    url = "%s" % url
-    m = re.match(regex_mbed_url, url)
-    if m:
-        if format == "http":
-            url = 'http://%s/%s/%s/%s/%s' % (m.group(2), m.group(4), m.group(5), m.group(6), m.group(7))
-        else:
-            url = 'https://%s/%s/%s/%s/%s' % (m.group(2), m.group(4), m.group(5), m.group(6), m.group(7))
-    else:
-        m = re.match(regex_git_url, url)
-        if m:
-            if format == "ssh":
-                url = 'ssh://%s%s/%s.git' % (m.group(2) or 'git@', m.group(6), m.group(7))
-            elif format == "http":
-                url = 'http://%s%s/%s' % (m.group(2) if (m.group(2) and (m.group(5) or m.group(3) != 'git')) else '', m.group(6), m.group(7))
-            elif format == "https":
-                url = 'https://%s%s/%s' % (m.group(2) if (m.group(2) and (m.group(5) or m.group(3) != 'git')) else '', m.group(6), m.group(7))
-        else:
-            m = re.match(regex_hg_url, url)
-            if m:
+    @property
+    def rev(self):
+        return self.repo.group(3) if self.repo else None
+
+    @property
+    def plain(self):
+        return ParsedUrl.parse(self.repo.group(1)) if self.repo and self.repo.group(1) != self.raw else self
+
+    # URL components used for formatting as (kind, match)
+    @property
+    def components(self):
+        if 'components' not in self.forms:
+            m = regex_mbed_url.match(self.raw)
+            kind = 'mbed'
+            if not m:
+                m, kind = regex_git_url.match(self.raw), 'git'
+            if not m:
+                m, kind = regex_hg_url.match(self.raw), 'hg'
+            self.forms['components'] = (kind, m) if m else (None, None)
+        return self.forms['components']
+
+    # Host and path of the URL without revision
+    @property
+    def host(self):
+        kind, m = self.plain.components
+        return m.group(6) if kind == 'git' else (m.group(2) if m else None)
+
+    @property
+    def path(self):
+        kind, m = self.plain.components
+        if kind == 'mbed':
+            return '%s/%s/%s/%s' % (m.group(4), m.group(5), m.group(6), m.group(7))
+        return m.group(7) if kind == 'git' else (m.group(3) if m else None)
+
+    # The URL in the given protocol form: "default", "http", "https" or "ssh"
+    def format(self, format="default"):
+        if format not in self.forms:
+            url = self.raw
+            kind, m = self.components
+            if kind == 'mbed':
+                if format == "http":
+                    url = 'http://%s/%s/%s/%s/%s' % (m.group(2), m.group(4), m.group(5), m.group(6), m.group(7))
+                else:
+                    url = 'https://%s/%s/%s/%s/%s' % (m.group(2), m.group(4), m.group(5), m.group(6), m.group(7))
+            elif kind == 'git':
+                if format == "ssh":
+                    url = 'ssh://%s%s/%s.git' % (m.group(2) or 'git@', m.group(6), m.group(7))
+                elif format == "http":
+                    url = 'http://%s%s/%s' % (m.group(2) if (m.group(2) and (m.group(5) or m.group(3) != 'git')) else '', m.group(6), m.group(7))
+                elif format == "https":
+                    url = 'https://%s%s/%s' % (m.group(2) if (m.group(2) and (m.group(5) or m.group(3) != 'git')) else '', m.group(6), m.group(7))
+            elif kind == 'hg':
                 if format == "ssh":
                     url = 'ssh://%s/%s' % (m.group(2), m.group(3))
                 elif format == "http":
                     url = 'http://%s/%s' % (m.group(2), m.group(3))
                 elif format == "https":
                     url = 'https://%s/%s' % (m.group(2), m.group(3))
-    return url
+            self.forms[format] = url
+        return self.forms[format]
+
+
+def formaturl(url, format="default"):
+    return ParsedUrl.parse("%s" % url).format(format)
 
 
 # Subparser handling
@@ -1614,44 +3178,69 @@ parser = argparse.ArgumentParser(prog='mbed',
     formatter_class=argparse.RawTextHelpFormatter)
 subparsers = parser.add_subparsers(title="Commands", metavar="           ")
 parser.add_argument("--version", action="store_true", dest="version", help="print version number and exit")
+parser.add_argument("--profile-cli", dest="profile_cli", metavar="FILE", help="profile the command, write the statistics to a pstats file (default: %s)\nand print the top %d entries by cumulative time" % (profile_file, profile_top))
 subcommands = {}
+# Subcommand definitions in registration order. Subparsers are constructed on demand by build_parser()
+subcommand_defs = []
 
 # Process handling
 def subcommand(name, *args, **kwargs):
     def __subcommand(command):
-        if not kwargs.get('description') and kwargs.get('help'):
-            kwargs['description'] = kwargs['help']
-        if not kwargs.get('formatter_class'):
-            kwargs['formatter_class'] = argparse.RawDescriptionHelpFormatter
-
-        subparser = subparsers.add_parser(name, **kwargs)
-        subcommands[name] = subparser
-
-        for arg in args:
-            arg = dict(arg)
-            opt = arg['name']
-            del arg['name']
-
-            if isinstance(opt, basestring):
-                subparser.add_argument(opt, **arg)
-            else:
-                subparser.add_argument(*opt, **arg)
+        subcommand_defs.append((name, args, kwargs, command))
+        return command
+    return __subcommand
 
-        subparser.add_argument("-v", "--verbose", action="store_true", dest="verbose", help="Verbose diagnostic output")
-        subparser.add_argument("-vv", "--very_verbose", action="store_true", dest="very_verbose", help="Very verbose diagnostic output")
+def add_subcommand(name, args, kwargs, command):
+    kwargs = dict(kwargs)
+    if not kwargs.get('description') and kwargs.get('help'):
+        kwargs['description'] = kwargs['help']
+    if not kwargs.get('formatter_class'):
+        kwargs['formatter_class'] = argparse.RawDescriptionHelpFormatter
 
-        def thunk(parsed_args):
-            argv = [arg['dest'] if 'dest' in arg else arg['name'] for arg in args]
-            argv = [(arg if isinstance(arg, basestring) else arg[-1]).strip('-').replace('-', '_')
-                    for arg in argv]
-            argv = {arg: vars(parsed_args)[arg] for arg in argv
-                    if vars(parsed_args)[arg] is not None}
+    subparser = subparsers.add_parser(name, **kwargs)
+    subcommands[name] = subparser
 
-            return command(**argv)
+    for arg in args:
+        arg = dict(arg)
+        opt = arg['name']
+        del arg['name']
 
-        subparser.set_defaults(command=thunk)
-        return command
-    return __subcommand
+        if isinstance(opt, basestring):
+            subparser.add_argument(opt, **arg)
+        else:
+            subparser.add_argument(*opt, **arg)
+
+    subparser.add_argument("-v", "--verbose", action="store_true", dest="verbose", help="Verbose diagnostic output")
+    subparser.add_argument("-vv", "--very_verbose", action="store_true", dest="very_verbose", help="Very verbose diagnostic output")
+    subparser.add_argument("--trace", dest="trace", help="Write a trace of all processes, directory tree walks and cache hits with their timings to this file (Chrome trace event format)")
+    subparser.add_argument("--spawn-stats", dest="spawn_stats", help="Write the number of started processes per executable and verb (e.g. \"git fetch\") to this file as JSON")
+
+    def thunk(parsed_args):
+        argv = [arg['dest'] if 'dest' in arg else arg['name'] for arg in args]
+        argv = [(arg if isinstance(arg, basestring) else arg[-1]).strip('-').replace('-', '_')
+                for arg in argv]
+        argv = {arg: vars(parsed_args)[arg] for arg in argv
+                if vars(parsed_args)[arg] is not None}
+
+        return command(**argv)
+
+    subparser.set_defaults(command=thunk)
+    return subparser
+
+# Only the invoked command gets its full argument tree. The others are registered with their
+# help text alone, which is all the top-level help and the invalid choice error need.
+def build_parser(argv):
+    names = [name for name, _, _, _ in subcommand_defs]
+    invoked = next((a for a in argv if a in names), None)
+
+    for name, args, kwargs, command in subcommand_defs:
+        if name == invoked:
+            add_subcommand(name, args, kwargs, command)
+        elif 'help' in kwargs:
+            subparsers.add_parser(name, help=kwargs['help'], add_help=False)
+        else:
+            subparsers.add_parser(name, add_help=False)
+    return parser
 
 
 # New command
@@ -1850,9 +3439,10 @@ def remove(path):
 
     lib = Repo.fromrepo(path)
     action("Removing library \"%s\" in \"%s\"" % (lib.name, lib.path))
-    rmtree_readonly(lib.path)
+    trash(lib.path)
     repo.remove(lib.lib)
     repo.unignore(relpath(repo.path, lib.path))
+    purge_trash()
 
 
 # Deploy command
@@ -1883,6 +3473,7 @@ def deploy(ignore=False, depth=None, protocol=None, top=True):
         program.post_action()
         if program.is_classic:
             program.update_tools('.temp')
+        purge_trash()
 
 # Publish command
 @subcommand('publish',
@@ -1982,7 +3573,8 @@ def update(rev=None, clean=False, clean_files=False, clean_deps=False, ignore=Fa
             repo.revtype(rev, True)))
 
         try:
-            repo.update(rev, clean, clean_files, repo.is_local)
+            with downloading(repo.path):
+                repo.update(rev, clean, clean_files, repo.is_local)
         except ProcessException as e:
             err = "Unable to update \"%s\" to %s" % (repo.name, repo.revtype(rev, True))
             if depth:
@@ -2006,7 +3598,7 @@ def update(rev=None, clean=False, clean_files=False, clean_deps=False, ignore=Fa
                 gc, msg = lib_repo.can_update(clean, clean_deps)
             if gc:
                 action("Removing library \"%s\" (obsolete)" % (relpath(cwd_root, lib.path)))
-                rmtree_readonly(lib.path)
+                trash(lib.path)
                 repo.unignore(relpath(repo.path, lib.path))
             else:
                 if ignore:
@@ -2028,7 +3620,7 @@ def update(rev=None, clean=False, clean_files=False, clean_deps=False, ignore=Fa
                     gc, msg = lib_repo.can_update(clean, clean_deps)
                 if gc:
                     action("Removing library \"%s\" (changed URL). Will add from new URL." % (relpath(cwd_root, lib.path)))
-                    rmtree_readonly(lib.path)
+                    trash(lib.path)
                     repo.unignore(relpath(repo.path, lib.path))
                 else:
                     if ignore:
@@ -2051,6 +3643,7 @@ def update(rev=None, clean=False, clean_files=False, clean_deps=False, ignore=Fa
         program.post_action()
         if program.is_classic:
             program.update_tools('.temp')
+        purge_trash()
 
 
 # Synch command
@@ -2112,6 +3705,8 @@ def sync(recursive=True, keep_refs=False, top=True):
     if top and cwd_type == "library":
         repo = Repo.fromrepo()
         repo.write()
+    if top:
+        purge_trash()
 
 
 # List command
@@ -2158,8 +3753,8 @@ def status_(ignore=False):
 
 # Compile command which invokes the mbed OS native build system
 @subcommand('compile',
-    dict(name=['-t', '--toolchain'], help='Compile toolchain. Example: ARM, GCC_ARM, IAR'),
-    dict(name=['-m', '--target'], help='Compile target MCU. Example: K64F, NUCLEO_F401RE, NRF51822...'),
+    dict(name=['-t', '--toolchain'], help='Compile toolchain. Example: ARM, GCC_ARM, IAR. Use a comma separated list to build with multiple toolchains.'),
+    dict(name=['-m', '--target'], help='Compile target MCU. Example: K64F, NUCLEO_F401RE, NRF51822... Use a comma separated list to build for multiple targets.'),
     dict(name=['--profile'], action='append', help='Path of a build profile configuration file. Example: mbed-os/tools/profiles/debug.json'),
     dict(name='--library', dest='compile_library', action='store_true', help='Compile the current program or library as a static library.'),
     dict(name='--config', dest='compile_config', action='store_true', help='Show run-time compile configuration'),
@@ -2167,13 +3762,19 @@ def status_(ignore=False):
     dict(name='--source', action='append', help='Source directory. Default: . (current dir)'),
     dict(name='--build', help='Build directory. Default: build/'),
     dict(name=['-c', '--clean'], action='store_true', help='Clean the build directory before compiling'),
-    dict(name=['-f', '--flash'], action='store_true', help='Flash the built firmware onto a connected target.'),
+    dict(name=['-f', '--flash'], nargs='?', const=True, help='Flash the built firmware onto a connected target. Use "all" to flash all connected targets of the selected target type, or a comma separated list of target IDs (or unique ID prefixes) to flash specific targets.'),
     dict(name=['-N', '--artifact-name'], help='Name of the built program or library'),
     dict(name=['-S', '--supported'], dest='supported', action='store_true', help='Shows supported matrix of targets and toolchains'),
     dict(name='--app-config', dest="app_config", help="Path of an app configuration file (Default is to look for 'mbed_app.json')"),
+    dict(name='--server', dest='build_server', action='store_true', help='Compile through a background build server that keeps the mbed OS tools loaded between compiles. The server is restarted when the tools change.'),
+    dict(name='--matrix', help='Path of a file listing target and toolchain pairs to build, one "TARGET TOOLCHAIN" pair per line.'),
+    dict(name='--parallel', type=int, help='Number of builds to run concurrently when building for multiple targets or toolchains. Default: number of CPUs.'),
+    dict(name='--force', action='store_true', help='Run the build tools even if the sources and build settings are unchanged since the last successful build.'),
+    dict(name='--force-flash', dest='force_flash', action='store_true', help='Flash the firmware even if the target was last flashed with the same firmware.'),
+    dict(name='--json', dest='json_output', action='store_true', help='Show the supported matrix of targets and toolchains (-S) as JSON.'),
     help='Compile code using the mbed build tools',
     description=("Compile this program using the mbed build tools."))
-def compile_(toolchain=None, target=None, profile=False, compile_library=False, compile_config=False, config_prefix=None, source=False, build=False, clean=False, flash=False, artifact_name=None, supported=False, app_config=None):
+def compile_(toolchain=None, target=None, profile=False, compile_library=False, compile_config=False, config_prefix=None, source=False, build=False, clean=False, flash=False, artifact_name=None, supported=False, app_config=None, build_server=False, matrix=None, parallel=None, force=False, force_flash=False, json_output=False):
     # Gather remaining arguments
     args = remainder
     # Find the root of the program
@@ -2192,17 +3793,80 @@ def compile_(toolchain=None, target=None, profile=False, compile_library=False,
         source = [os.path.relpath(program.path, orig_path)]
 
     if supported:
-        popen([python_cmd, '-u', os.path.join(tools_dir, 'make.py')]
-              + (['-S'] if supported else []) + (['-v'] if very_verbose else [])
-              + (['--app-config', app_config] if app_config else [])
-              + args,
-              env=env)
+        program.run_listing([python_cmd, '-u', os.path.join(tools_dir, 'make.py')]
+                            + (['-S'] if supported else []) + (['-v'] if very_verbose else [])
+                            + (['--app-config', app_config] if app_config else [])
+                            + args,
+                            program.get_tools_key(tools_dir), env, json_output)
         return
 
-    target = program.get_target(target)
-    tchain = program.get_toolchain(toolchain)
+    if matrix:
+        builds = program.get_matrix(matrix)
+    else:
+        builds = [(t, tc) for t in program.get_targets(target) for tc in program.get_toolchains(toolchain)]
     macros = program.get_macros()
 
+    if len(builds) > 1:
+        if compile_config or flash or build_server:
+            error("The --config, --flash and --server options cannot be used when building for multiple targets or toolchains.", 1)
+        if not build:
+            program.ignore_build_dir()
+
+        jobs = parallel or program.cpu_count()
+        if not [a for a in args if a.startswith('-j') or a.startswith('--jobs')]:
+            # Share the CPUs between the concurrent builds instead of letting each use all of them
+            args = args + ['-j', str(max(1, program.cpu_count() // jobs))]
+
+        # The build keys are computed with the environment before the compiler cache is set up, like in single builds
+        key_env = env.copy()
+        tools_key = program.get_tools_key(tools_dir)
+        ccache = program.setup_compiler_cache(env, [tc for _, tc in builds])
+        ccache_stats = program.get_compiler_cache_stats(ccache, env) if ccache else None
+
+        # Libraries are only left out of the builds if they could be prebuilt for every combination
+        prebuilt = {}
+        if not compile_library:
+            for build_target in builds:
+                prebuilt[build_target] = dict(program.prepare_cached_libs(tools_dir, build_target[0], build_target[1], macros, profile, app_config, env, force))
+        lib_ignores = sorted(set.intersection(*[set(libs.keys()) for libs in prebuilt.values()])) if prebuilt else []
+
+        def build_one(build_target):
+            target, tchain = build_target
+            build_path = os.path.join(build, target, tchain) if build else None
+            script, build_args = program.get_build_args(orig_path, target, tchain, macros, profile, source, build_path, clean,
+                                                        compile_library, artifact_name, app_config, args)
+            build_path = build_args[build_args.index('--build') + 1]
+            key = None if compile_library else program.get_build_key(tools_key, target, tchain, macros, profile, source, build_path, artifact_name, app_config, args, key_env)
+            if key and not clean and not force and program.is_build_cached(build_path, key):
+                with output_lock:
+                    log("[%s/%s] Build is up to date (use --force to rebuild)\n" % (target, tchain))
+                return 0
+            if lib_ignores:
+                script, build_args = program.get_build_args(orig_path, target, tchain, macros, profile, source + [prebuilt[build_target][l] for l in lib_ignores],
+                                                            build_path, clean, compile_library, artifact_name, app_config, args + program.get_ignore_args(lib_ignores))
+            code = pprefixed('%s/%s' % (target, tchain), [python_cmd, '-u', os.path.join(tools_dir, script)] + build_args, env=env)
+            if code == 0 and key:
+                program.set_build_cached(build_path, key, artifact_name)
+            return code
+
+        action("Building %d target and toolchain combinations (%d at a time)" % (len(builds), jobs))
+        results = run_parallel(builds, build_one, jobs)
+
+        if ccache:
+            program.report_compiler_cache(ccache, env, ccache_stats)
+
+        action("Build summary:")
+        failed = 0
+        for (target, tchain), code, duration in results:
+            if code != 0:
+                failed += 1
+            log("  %-24s %-10s %-16s %8.1fs\n" % (target, tchain, 'OK' if code == 0 else ('FAILED (%s)' % code), duration))
+        if failed:
+            error("%d of %d builds failed." % (failed, len(builds)), 1)
+        return
+
+    target, tchain = builds[0]
+
     if compile_config:
         # Compile configuration
         popen([python_cmd, os.path.join(tools_dir, 'get_config.py')]
@@ -2217,60 +3881,72 @@ def compile_(toolchain=None, target=None, profile=False, compile_library=False,
         if not build:
             program.ignore_build_dir()
 
-        build_path = build
+        script, build_args = program.get_build_args(orig_path, target, tchain, macros, profile, source, build, clean,
+                                                    compile_library, artifact_name, app_config, args)
+        build_path = build_args[build_args.index('--build') + 1]
 
-        if compile_library:
-            # Compile as a library (current dir is default)
-            if not build_path:
-                build_path = os.path.join(os.path.relpath(program.path, orig_path), program.build_dir, 'libraries', os.path.basename(orig_path), target, tchain)
+        # Application builds are skipped if nothing changed since the last successful build
+        key = None if compile_library else program.get_build_key(program.get_tools_key(tools_dir), target, tchain, macros, profile, source, build_path,
+                                                                 artifact_name, app_config, args, env)
 
-            popen([python_cmd, '-u', os.path.join(tools_dir, 'build.py')]
-                  + list(chain.from_iterable(izip(repeat('-D'), macros)))
-                  + ['-t', tchain, '-m', target]
-                  + list(chain.from_iterable(izip(repeat('--profile'), profile or [])))
-                  + list(chain.from_iterable(izip(repeat('--source'), source)))
-                  + ['--build', build_path]
-                  + (['-c'] if clean else [])
-                  + (['--artifact-name', artifact_name] if artifact_name else [])
-                  + (['-v'] if verbose else [])
-                  + args,
-                  env=env)
+        if key and not clean and not force and program.is_build_cached(build_path, key):
+            action("Build is up to date. Reusing \"%s\" (use --force to rebuild)" % ', '.join(program.get_build_artifacts(build_path, artifact_name)))
         else:
-            # Compile as application (root is default)
-            if not build_path:
-                build_path = os.path.join(os.path.relpath(program.path, orig_path), program.build_dir, target, tchain)
+            ccache = program.setup_compiler_cache(env, [tchain])
+            ccache_stats = program.get_compiler_cache_stats(ccache, env) if ccache else None
 
-            popen([python_cmd, '-u', os.path.join(tools_dir, 'make.py')]
-                  + list(chain.from_iterable(izip(repeat('-D'), macros)))
-                  + ['-t', tchain, '-m', target]
-                  + list(chain.from_iterable(izip(repeat('--profile'), profile or [])))
-                  + list(chain.from_iterable(izip(repeat('--source'), source)))
-                  + ['--build', build_path]
-                  + (['-c'] if clean else [])
-                  + (['--artifact-name', artifact_name] if artifact_name else [])
-                  + (['--app-config', app_config] if app_config else [])
-                  + (['-v'] if verbose else [])
-                  + args,
-                  env=env)
+            prebuilt = [] if compile_library else program.prepare_cached_libs(tools_dir, target, tchain, macros, profile, app_config, env, force)
+            if prebuilt:
+                script, build_args = program.get_build_args(orig_path, target, tchain, macros, profile, source + [p for _, p in prebuilt], build, clean,
+                                                            compile_library, artifact_name, app_config, args + program.get_ignore_args([l for l, _ in prebuilt]))
 
-            if flash:
-                fw_name = artifact_name if artifact_name else program.name
-                fw_fbase = os.path.join(build_path, fw_name)
-                fw_file = fw_fbase + ('.hex' if os.path.exists(fw_fbase+'.hex') else '.bin')
-                if not os.path.exists(fw_file):
-                    error("Build program file (firmware) not found \"%s\"" % fw_file, 1)
-                detected = program.detect_target()
+            if build_server and not compile_library:
+                BuildServer(program, tools_dir, target, env).run(script, build_args, env)
+            else:
+                popen([python_cmd, '-u', os.path.join(tools_dir, script)] + build_args, env=env)
 
-                try:
-                    from mbed_host_tests.host_tests_toolbox import flash_dev, reset_dev
-                except (IOError, ImportError, OSError):
-                    error("The '-f/--flash' option requires that the 'mbed-greentea' python module is installed.\nYou can install mbed-ls by running 'pip install mbed-greentea'.", 1)
+            if key:
+                program.set_build_cached(build_path, key, artifact_name)
+            if ccache:
+                program.report_compiler_cache(ccache, env, ccache_stats)
 
-                if not flash_dev(detected['msd'], fw_file, program_cycle_s=2):
-                    error("Unable to flash the target board connected to your system.", 1)
+        if flash and not compile_library:
+            fw_name = artifact_name if artifact_name else program.name
+            fw_fbase = os.path.join(build_path, fw_name)
+            fw_file = fw_fbase + ('.hex' if os.path.exists(fw_fbase+'.hex') else '.bin')
+            if not os.path.exists(fw_file):
+                error("Build program file (firmware) not found \"%s\"" % fw_file, 1)
+            boards = program.get_flash_boards(flash, target)
 
-                if not reset_dev(detected['port']):
+            try:
+                from mbed_host_tests.host_tests_toolbox import flash_dev, reset_dev
+            except (IOError, ImportError, OSError):
+                error("The '-f/--flash' option requires that the 'mbed-greentea' python module is installed.\nYou can install mbed-ls by running 'pip install mbed-greentea'.", 1)
+
+            if len(boards) > 1:
+                action("Flashing \"%s\" onto %d targets" % (fw_file, len(boards)))
+            results = flash_boards(boards, fw_file, flash_dev, reset_dev, force=force_flash)
+
+            if len(results) == 1:
+                status = results[0][1]
+                if status == 'unchanged':
+                    action("The target is already flashed with \"%s\" (use --force-flash to flash anyway)" % fw_file)
+                elif status == 'flash':
+                    error("Unable to flash the target board connected to your system.", 1)
+                elif status == 'reset':
                     error("Unable to reset the target board connected to your system.\nThis might be caused by an old interface firmware.\nPlease check the board page for new firmware.", 1)
+                elif status != 'ok':
+                    error("Unable to flash the target board connected to your system: %s" % status, 1)
+            else:
+                action("Flash summary:")
+                failed = 0
+                for board, status, duration in results:
+                    if status not in ['ok', 'unchanged']:
+                        failed += 1
+                    status = {'ok': 'OK', 'unchanged': 'UNCHANGED', 'flash': 'FAILED (unable to flash)', 'reset': 'FAILED (unable to reset)'}.get(status, 'FAILED (%s)' % status)
+                    log("  %-24s %-16s %-24s %8.1fs\n" % (board['id'], board['name'], status, duration))
+                if failed:
+                    error("%d of %d targets failed to flash or reset." % (failed, len(results)), 1)
 
     program.set_defaults(target=target, toolchain=tchain)
 
@@ -2290,9 +3966,13 @@ def compile_(toolchain=None, target=None, profile=False, compile_library=False,
     dict(name=['-c', '--clean'], action='store_true', help='Clean the build directory before compiling'),
     dict(name='--test-spec', dest="test_spec", help="Path used for the test spec file used when building and running tests (the default path is the build directory)"),
     dict(name='--app-config', dest="app_config", help="Path of an app configuration file (Default is to look for 'mbed_app.json')"),
+    dict(name='--json', dest='json_output', action='store_true', help='Show the list of tests that can be built (--compile-list) as JSON.'),
+    dict(name='--affected-since', dest='affected_since', help='Only build and run the tests affected by changes in the program and its libraries since a revision of the program, e.g. a branch, tag or commit.'),
+    dict(name='--no-test-cache', dest='no_test_cache', action='store_true', help='Run all tests, including tests that passed before with identical binaries on the same target.'),
+    dict(name='--shard-across-boards', dest='shard_across_boards', action='store_true', help='Split the tests over all connected boards of the target and run them concurrently, one greentea process per board.'),
     help='Find, build and run tests',
     description=("Find, build, and run tests in a program and libraries"))
-def test_(toolchain=None, target=None, compile_list=False, run_list=False, compile_only=False, run_only=False, tests_by_name=None, source=False, profile=False, build=False, clean=False, test_spec=None, app_config=None):
+def test_(toolchain=None, target=None, compile_list=False, run_list=False, compile_only=False, run_only=False, tests_by_name=None, source=False, profile=False, build=False, clean=False, test_spec=None, app_config=None, shard_across_boards=False, no_test_cache=False, affected_since=None, json_output=False):
     # Gather remaining arguments
     args = remainder
     # Find the root of the program
@@ -2327,22 +4007,44 @@ def test_(toolchain=None, target=None, compile_list=False, run_list=False, compi
             # Create the path to the test spec file
             test_spec = os.path.join(build_path, 'test_spec.json')
 
+        if affected_since:
+            affected = program.get_affected_tests(source, affected_since)
+            if affected is None:
+                action("All tests may be affected by the changes since \"%s\"" % affected_since)
+            else:
+                if tests_by_name:
+                    import fnmatch
+                    patterns = [n.strip() for n in tests_by_name.split(',') if n.strip()]
+                    affected = [t for t in affected if any(fnmatch.fnmatch(t, p) for p in patterns)]
+                if not affected:
+                    action("No tests are affected by the changes since \"%s\"" % affected_since)
+                    return
+                action("%d tests are affected by the changes since \"%s\": %s" % (len(affected), affected_since, ', '.join(sorted(affected))))
+                tests_by_name = ','.join(sorted(affected))
+
         if compile_list:
-            popen([python_cmd, '-u', os.path.join(tools_dir, 'test.py'), '--list']
-                  + list(chain.from_iterable(izip(repeat('--profile'), profile or [])))
-                  + ['-t', tchain, '-m', target]
-                  + list(chain.from_iterable(izip(repeat('--source'), source)))
-                  + (['-n', tests_by_name] if tests_by_name else [])
-                  + (['-v'] if verbose else [])
-                  + (['--app-config', app_config] if app_config else [])
-                  + args,
-                  env=env)
+            # The tests that can be built also depend on the source tree
+            key = program.get_tools_key(tools_dir) + program.get_source_key(source)
+            if app_config and os.path.isfile(app_config):
+                key += ':%s' % os.stat(app_config).st_mtime
+            program.run_listing([python_cmd, '-u', os.path.join(tools_dir, 'test.py'), '--list']
+                                + list(chain.from_iterable(izip(repeat('--profile'), profile or [])))
+                                + ['-t', tchain, '-m', target]
+                                + list(chain.from_iterable(izip(repeat('--source'), source)))
+                                + (['-n', tests_by_name] if tests_by_name else [])
+                                + (['-v'] if verbose else [])
+                                + (['--app-config', app_config] if app_config else [])
+                                + args,
+                                key, env, json_output)
 
         if compile_only or build_and_run_tests:
             # If the user hasn't supplied a build directory, ignore the default build directory
             if not build:
                 program.ignore_build_dir()
 
+            ccache = program.setup_compiler_cache(env, [tchain])
+            ccache_stats = program.get_compiler_cache_stats(ccache, env) if ccache else None
+
             popen([python_cmd, '-u', os.path.join(tools_dir, 'test.py')]
                   + list(chain.from_iterable(izip(repeat('-D'), macros)))
                   + list(chain.from_iterable(izip(repeat('--profile'), profile or [])))
@@ -2357,6 +4059,9 @@ def test_(toolchain=None, target=None, compile_list=False, run_list=False, compi
                   + args,
                   env=env)
 
+            if ccache:
+                program.report_compiler_cache(ccache, env, ccache_stats)
+
         if run_list:
             popen(['mbedgt', '--test-spec', test_spec, '--list']
                   + (['-n', tests_by_name] if tests_by_name else [])
@@ -2365,27 +4070,65 @@ def test_(toolchain=None, target=None, compile_list=False, run_list=False, compi
                   env=env)
 
         if run_only or build_and_run_tests:
-            popen(['mbedgt', '--test-spec', test_spec]
-                  + (['-n', tests_by_name] if tests_by_name else [])
-                  + (['-V'] if verbose else [])
-                  + args,
-                  env=env)
+            # Greentea flashes the test binaries onto the boards, so the records of the firmware
+            # last flashed by compile --flash are no longer valid
+            flashed = Store('flash')
+            if os.path.isfile(flashed.path):
+                flashed.save({})
+
+            # Tests whose binaries already passed with the same settings are not run again
+            run_tests = tests_by_name
+            keys = {}
+            if not no_test_cache:
+                tests = program.get_spec_tests(test_spec, tests_by_name)
+                keys = program.get_test_keys(test_spec, tests, target, tchain, args)
+                passed = Store('test-results').load()
+                cached = [t for t in tests if keys.get(t) in passed]
+                if cached:
+                    trace('test results', 'cache', tests=cached)
+                    action("Skipping %d tests that passed with identical binaries before (use --no-test-cache to run them):" % len(cached))
+                    for t in cached:
+                        log("  %-60s OK (cached)\n" % t)
+                    run_tests = ','.join(t for t in tests if t not in cached)
+                if '--report-json' not in args:
+                    args = args + ['--report-json', os.path.join(os.path.dirname(test_spec), 'test_report.json')]
+                report_file = args[args.index('--report-json') + 1]
+
+            if run_tests == '':
+                action("All tests passed before. Nothing to run.")
+            else:
+                try:
+                    if shard_across_boards:
+                        program.run_sharded_tests(test_spec, target, tchain, run_tests, args, env)
+                    else:
+                        popen(['mbedgt', '--test-spec', test_spec]
+                              + (['-n', run_tests] if run_tests else [])
+                              + (['-V'] if verbose else [])
+                              + args,
+                              env=env)
+                finally:
+                    if keys:
+                        program.set_tests_passed(report_file, keys)
 
     program.set_defaults(target=target, toolchain=tchain)
 
 
 # Export command
 @subcommand('export',
-    dict(name=['-i', '--ide'], help='IDE to create project files for. Example: UVISION4, UVISION5, GCC_ARM, IAR, COIDE'),
-    dict(name=['-m', '--target'], help='Export for target MCU. Example: K64F, NUCLEO_F401RE, NRF51822...'),
+    dict(name=['-i', '--ide'], help='IDE to create project files for. Example: UVISION4, UVISION5, GCC_ARM, IAR, COIDE. Use a comma separated list to export to multiple IDEs.'),
+    dict(name=['-m', '--target'], help='Export for target MCU. Example: K64F, NUCLEO_F401RE, NRF51822... Use a comma separated list to export for multiple targets.'),
     dict(name='--source', action='append', help='Source directory. Default: . (current dir)'),
     dict(name=['-c', '--clean'], action='store_true', help='Clean the build directory before compiling'),
     dict(name=['-S', '--supported'], dest='supported', action='store_true', help='Shows supported matrix of targets and toolchains'),
     dict(name='--app-config', dest="app_config", help="Path of an app configuration file (Default is to look for 'mbed_app.json')"),
+    dict(name='--json', dest='json_output', action='store_true', help='Show the supported matrix of targets and IDEs (-S) as JSON.'),
+    dict(name='--parallel', type=int, help='Number of exports to run concurrently when exporting for multiple targets or IDEs. Default: number of CPUs.'),
+    dict(name='--force', action='store_true', help='Export even if the sources and export settings are unchanged since the last export.'),
     help='Generate an IDE project',
     description=(
         "Generate IDE project files for the current program."))
-def export(ide=None, target=None, source=False, clean=False, supported=False, app_config=None):
+def export(ide=None, target=None, source=False, clean=False, supported=False, app_config=None, json_output=False, parallel=None, force=False):
+    import hashlib
     # Gather remaining arguments
     args = remainder
     # Find the root of the program
@@ -2401,33 +4144,90 @@ def export(ide=None, target=None, source=False, clean=False, supported=False, ap
     env = program.get_env()
 
     if supported:
-        popen([python_cmd, '-u', os.path.join(tools_dir, 'project.py')]
-              + (['-S'] if supported else []) + (['-v'] if very_verbose else []),
-              env=env)
+        program.run_listing([python_cmd, '-u', os.path.join(tools_dir, 'project.py')]
+                            + (['-S'] if supported else []) + (['-v'] if very_verbose else []),
+                            program.get_tools_key(tools_dir), env, json_output)
         return
 
-    target = program.get_target(target)
+    targets = program.get_targets(target)
     macros = program.get_macros()
 
     if not ide:
         error('Please specify ide using the -i switch')
+    ides = [i.strip().lower() for i in ide.split(',') if i.strip()]
 
     if not source or len(source) == 0:
         source = [os.path.relpath(program.path, orig_path)]
 
     program.ignore_build_dir()
 
-    popen([python_cmd, '-u', os.path.join(tools_dir, 'project.py')]
-          + list(chain.from_iterable(izip(repeat('-D'), macros)))
-          + ['-i', ide.lower()]
-          + ['-m', target]
-          + (['-c'] if clean else [])
-          + list(chain.from_iterable(izip(repeat('--source'), source)))
-          + (['--app-config', app_config] if app_config else [])
-          + args,
-          env=env)
+    exports = [(t, i) for t in targets for i in ides]
+    tools_key = program.get_tools_key(tools_dir)
+
+    def export_one(export_target):
+        target, ide = export_target
+        if len(exports) > 1:
+            # Every export is written into its own directory, which the tools use as the project
+            # directory when it is the first source directory. The project is named after it
+            export_dir = os.path.join(program.path, program.build_dir, 'export', target, ide, program.name)
+            if not os.path.isdir(export_dir):
+                os.makedirs(export_dir)
+            export_source = [export_dir] + source
+            store = Store('.mbed_export', export_dir)
+        else:
+            export_source = source
+            store = Store('.mbed_export_%s_%s' % (target, ide), os.path.join(program.path, program.build_dir))
+
+        def export_key():
+            h = hashlib.sha1(tools_key + program.get_source_key(source))
+            h.update(repr([target, ide, macros, app_config, args]))
+            return h.hexdigest()
+
+        if not clean and not force and store.load().get('key') == export_key():
+            trace('export', 'cache', target=target, ide=ide)
+            if len(exports) > 1:
+                with output_lock:
+                    log("[%s/%s] Export is up to date (use --force to export again)\n" % (target, ide))
+            else:
+                action("Export is up to date (use --force to export again)")
+            return 0
+
+        command = ([python_cmd, '-u', os.path.join(tools_dir, 'project.py')]
+                   + list(chain.from_iterable(izip(repeat('-D'), macros)))
+                   + ['-i', ide]
+                   + ['-m', target]
+                   + (['-c'] if clean else [])
+                   + list(chain.from_iterable(izip(repeat('--source'), export_source)))
+                   + (['--app-config', app_config] if app_config else [])
+                   + args)
+        if len(exports) > 1:
+            code = pprefixed('%s/%s' % (target, ide), command, env=env)
+        else:
+            popen(command, env=env)
+            code = 0
+        if code == 0:
+            # The key is taken after the export, as project files may be written into the sources
+            store.save({'key': export_key()})
+        return code
+
+    if len(exports) == 1:
+        export_one(exports[0])
+    else:
+        jobs = parallel or program.cpu_count()
+        action("Exporting %d target and IDE combinations (%d at a time)" % (len(exports), jobs))
+        results = run_parallel(exports, export_one, jobs)
+
+        action("Export summary:")
+        failed = 0
+        for (target, ide), code, duration in results:
+            if code != 0:
+                failed += 1
+            log("  %-24s %-16s %-16s %8.1fs\n" % (target, ide, 'OK' if code == 0 else ('FAILED (%s)' % code), duration))
+        action("The projects are in \"%s\"" % os.path.join(program.path, program.build_dir, 'export', '<TARGET>', '<IDE>', program.name))
+        if failed:
+            error("%d of %d exports failed." % (failed, len(exports)), 1)
 
-    program.set_defaults(target=target)
+    program.set_defaults(target=targets[0])
 
 
 # Test command
@@ -2473,7 +4273,8 @@ def detect():
         "Gets, sets or unsets mbed tool configuration options.\n"
         "Options can be global (via the --global switch) or local (per program)\n"
         "Global options are always overridden by local/program options.\n"
-        "Currently supported options: target, toolchain, protocol, depth, cache"))
+        "Currently supported options: target, toolchain, protocol, depth, cache,\n"
+        "cache_reference, compiler_cache, compiler_cache_size, library_cache, metrics, metrics_statsd"))
 def config_(var=None, value=None, global_cfg=False, unset=False, list_config=False):
     name = var
     var = str(var).upper()
@@ -2489,6 +4290,15 @@ def config_(var=None, value=None, global_cfg=False, unset=False, list_config=Fal
             log("No global configuration is set\n")
         log("\n")
 
+        e_vars = env_cfg_list().items()
+        action("Environment config:")
+        if e_vars:
+            for v in e_vars:
+                log("MBED_%s=%s\n" % (v[0], v[1]))
+        else:
+            log("No environment configuration is set\n")
+        log("\n")
+
         p = Program(os.getcwd())
         action("Local config (%s):" % p.path)
         if not p.is_cwd:
@@ -2512,7 +4322,8 @@ def config_(var=None, value=None, global_cfg=False, unset=False, list_config=Fal
                 g.set_cfg(var, value)
                 action('%s now set as global %s' % (value, name))
             else:
-                value = g.get_cfg(var)
+                # The environment layer isn't part of the global config
+                value = Cfg(g.path).get(var)
                 action(('%s' % value) if value else 'No global %s set' % (name))
         else:
             # Find the root of the program
@@ -2535,33 +4346,130 @@ def config_(var=None, value=None, global_cfg=False, unset=False, list_config=Fal
         subcommands['config'].error("too few arguments")
 
 
+# Metrics statistics command
+@subcommand('stats',
+    dict(name='name', nargs='?', help='Only show the statistics of this command, e.g. "deploy"'),
+    dict(name=['-l', '--libraries'], dest='libraries', action='store_true', help='Show the time spent per library.'),
+    dict(name='--json', dest='json_output', action='store_true', help='Show the statistics as JSON.'),
+    help='Show statistics of recorded commands',
+    description=(
+        "Shows percentiles of the duration, started processes, downloaded bytes and\n"
+        "cache hits of the commands recorded in the metrics log, and optionally of the\n"
+        "time spent per library. Enable the metrics log with 'mbed config -G metrics on'."))
+def stats_(name=None, libraries=False, json_output=False):
+    import json
+    records = [r for r in load_metrics() if not name or r.get('command') == name]
+    if not records:
+        if not metrics_enabled():
+            error("No commands have been recorded. Enable the metrics log with \"mbed config -G metrics on\".", 1)
+        error("No %scommands have been recorded." % ('"%s" ' % name if name else ''), 1)
+
+    commands = {}
+    for r in records:
+        commands.setdefault(r['command'], []).append(r)
+
+    stats = {}
+    for cmd, runs in sorted(commands.items()):
+        durations = [r['duration'] for r in runs]
+        processes = [sum(r['processes'].values()) for r in runs]
+        hits = {}
+        for r in runs:
+            for cache, count in r['cache_hits'].items():
+                hits[cache] = hits.get(cache, 0) + count
+        libs = {}
+        for r in runs:
+            for lib, duration in r['libraries'].items():
+                libs.setdefault(lib, []).append(duration)
+        stats[cmd] = {
+            'runs': len(runs),
+            'failed': len([r for r in runs if r['status']]),
+            'duration': dict(('p%d' % p, percentile(durations, p)) for p in [50, 90, 99]),
+            'processes': dict(('p%d' % p, percentile(processes, p)) for p in [50, 90, 99]),
+            'downloaded': sum(r['downloaded'] for r in runs),
+            'cache_hits': hits,
+            'libraries': dict((lib, dict([('runs', len(d))] + [('p%d' % p, percentile(d, p)) for p in [50, 90, 99]]))
+                              for lib, d in libs.items())}
+
+    if json_output:
+        log(json.dumps(stats, indent=2, sort_keys=True) + "\n")
+        return
+
+    log("%-12s %6s %6s %9s %9s %9s %10s %11s  %s\n" % ('Command', 'Runs', 'Failed', 'p50', 'p90', 'p99', 'Processes', 'Downloaded', 'Cache hits'))
+    for cmd, s in sorted(stats.items()):
+        log("%-12s %6d %6d %8.2fs %8.2fs %8.2fs %10d %10.1fM  %s\n" % (
+            cmd, s['runs'], s['failed'], s['duration']['p50'], s['duration']['p90'], s['duration']['p99'],
+            s['processes']['p50'], s['downloaded'] / 1048576.0,
+            ', '.join('%s %d' % hit for hit in sorted(s['cache_hits'].items())) or '-'))
+
+    if libraries:
+        for cmd, s in sorted(stats.items()):
+            if not s['libraries']:
+                continue
+            log("\n")
+            action("Time per library in \"%s\":" % cmd)
+            log("  %-40s %6s %9s %9s %9s\n" % ('Library', 'Runs', 'p50', 'p90', 'p99'))
+            for lib, l in sorted(s['libraries'].items(), key=lambda l: -l[1]['p90']):
+                log("  %-40s %6d %8.2fs %8.2fs %8.2fs\n" % (lib, l['runs'], l['p50'], l['p90'], l['p99']))
+
+
 # Build system and exporters
 @subcommand('target',
     dict(name='name', nargs='?', help='Default target name. Example: K64F, NUCLEO_F401RE, NRF51822...'),
     dict(name=['-G', '--global'], dest='global_cfg', action='store_true', help='Use global settings, not local'),
     dict(name=['-S', '--supported'], dest='supported', action='store_true', help='Shows supported matrix of targets and toolchains'),
+    dict(name='--json', dest='json_output', action='store_true', help='Show the supported matrix of targets and toolchains (-S) as JSON.'),
     help='Set or get default target',
     description=(
         "Set or get default toolchain\n"
         "This is an alias to 'mbed config [--global] target [name]'\n"))
-def target_(name=None, global_cfg=False, supported=False):
+def target_(name=None, global_cfg=False, supported=False, json_output=False):
     if supported:
-        return compile_(supported=supported)
+        return compile_(supported=supported, json_output=json_output)
     return config_('target', name, global_cfg=global_cfg)
 
 @subcommand('toolchain',
     dict(name='name', nargs='?', help='Default toolchain name. Example: ARM, GCC_ARM, IAR'),
     dict(name=['-G', '--global'], dest='global_cfg', action='store_true', help='Use global settings, not local'),
     dict(name=['-S', '--supported'], dest='supported', action='store_true', help='Shows supported matrix of targets and toolchains'),
+    dict(name='--json', dest='json_output', action='store_true', help='Show the supported matrix of targets and toolchains (-S) as JSON.'),
     help='Set or get default toolchain\n\n',
     description=(
         "Set or get default toolchain\n"
         "This is an alias to 'mbed config [--global] toolchain [name]'\n"))
-def toolchain_(name=None, global_cfg=False, supported=False):
+def toolchain_(name=None, global_cfg=False, supported=False, json_output=False):
     if supported:
-        return compile_(supported=supported)
+        return compile_(supported=supported, json_output=json_output)
     return config_('toolchain', name, global_cfg=global_cfg)
 
+# Internal command used to run the build server in the background (see 'compile --server')
+@subcommand('build-server',
+    dict(name='tools', help='Path to the mbed OS tools'),
+    dict(name='--key', help='Key identifying the tools revision and build settings'),
+    dict(name='--state', help='Path of the server state file'),
+    dict(name='--idle', type=int, help='Exit after being idle for the specified number of seconds'),
+    description="Runs the build server used by 'mbed compile --server'.")
+def build_server_(tools, key=None, state=None, idle=None):
+    BuildServer.serve(os.path.abspath(tools), key, os.path.abspath(state), idle)
+
+# Internal command used to delete the trash of a program in the background (see "mbed remove" and "mbed update")
+@subcommand('purge-trash',
+    dict(name='path', help='Path of the trash directory'),
+    description="Deletes the libraries that were moved to the trash directory of a program.")
+def purge_trash_(path):
+    for name in sorted(os.listdir(path)):
+        # Entries are claimed by renaming them, so concurrent purges never delete the same entry
+        claimed = os.path.join(path, '.purge-%d-%s' % (os.getpid(), re.sub(r'^\.purge-\d+-', '', name)))
+        try:
+            os.rename(os.path.join(path, name), claimed)
+            rmtree_readonly(claimed)
+        except OSError as e:
+            info("Unable to delete \"%s\": %s" % (os.path.join(path, name), e))
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
 @subcommand('help',
     help='This help screen')
 def help_():
@@ -2569,7 +4477,7 @@ def help_():
 
 
 def main():
-    global verbose, very_verbose, remainder, cwd_root
+    global verbose, very_verbose, remainder, cwd_root, trace_events, lib_times, downloads
 
     # Help messages adapt based on current dir
     cwd_root = os.getcwd()
@@ -2580,6 +4488,7 @@ def main():
             "Please refer to the online guide available at https://github.com/ARMmbed/mbed-cli")
 
     # Parse/run command
+    build_parser(sys.argv[1:])
     if len(sys.argv) <= 1:
         help_()
         sys.exit(1)
@@ -2588,14 +4497,32 @@ def main():
         log(ver+"\n")
         sys.exit(0)
 
-    pargs, remainder = parser.parse_known_args()
+    # A bare "--profile-cli" would take the command name as the profile file
+    argv = ['--profile-cli=' + profile_file if a == '--profile-cli' else a for a in sys.argv[1:]]
+    pargs, remainder = parser.parse_known_args(argv)
     status = 1
 
+    if pargs.trace:
+        trace_events = []
+        trace_file = os.path.abspath(pargs.trace)
+    if pargs.spawn_stats:
+        spawn_stats_file = os.path.abspath(pargs.spawn_stats)
+    command = next((a for a in sys.argv[1:] if a in subcommands), None)
+    metrics = command not in [None, 'stats', 'build-server'] and metrics_enabled()
+    if metrics:
+        import time
+        lib_times, downloads = [], []
+        start = time.time()
     try:
         very_verbose = pargs.very_verbose
         verbose = very_verbose or pargs.verbose
-        info('Working path \"%s\" (%s)' % (os.getcwd(), Repo.pathtype(cwd_root)))
-        status = pargs.command(pargs)
+        if verbose:
+            info('Working path \"%s\" (%s)' % (os.getcwd(), Repo.pathtype(cwd_root)))
+        with traced('mbed ' + ' '.join(sys.argv[1:]), 'command'):
+            if pargs.profile_cli:
+                status = profile_cli(os.path.abspath(pargs.profile_cli), pargs.command, pargs)
+            else:
+                status = pargs.command(pargs)
     except ProcessException as e:
         error(
             "\"%s\" returned error code %d.\n"
@@ -2612,8 +4539,25 @@ def main():
         sys.exit(255)
     except Exception as e:
         if very_verbose:
+            import traceback
             traceback.print_exc(file=sys.stdout)
         error("Unknown Error: %s" % e, 255)
+    finally:
+        if trace_events is not None:
+            write_trace(trace_file, 'mbed ' + ' '.join(sys.argv[1:]))
+        stats = spawn_stats('mbed ' + ' '.join(sys.argv[1:]))
+        if very_verbose:
+            info("Started %d processes%s" % (stats['total'], ''.join(
+                "\n    %4d %s" % (count, name) for name, count in sorted(stats['processes'].items(), key=lambda p: (-p[1], p[0])))))
+        if pargs.spawn_stats:
+            import json
+            try:
+                with open(spawn_stats_file, 'w') as f:
+                    json.dump(stats, f, indent=2, sort_keys=True)
+            except (IOError, OSError):
+                warning("Unable to write spawn statistics file \"%s\"" % spawn_stats_file)
+        if metrics:
+            record_metrics(command, time.time() - start, status or 0, stats)
     sys.exit(status or 0)
 
 
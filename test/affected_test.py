@@ -0,0 +1,81 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+import imp
+from util import *
+
+def write(fl, content):
+    if not os.path.isdir(os.path.dirname(fl)):
+        os.makedirs(os.path.dirname(fl))
+    with open(fl, 'w') as f:
+        f.write(content)
+
+def commit(dir, msg='test commit'):
+    with cd(dir):
+        popen(['git', 'add', '-A'])
+        popen(['git', 'commit', '-m', msg])
+        return pquery(['git', 'rev-parse', 'HEAD']).strip()
+
+# Program with a library and tests that include headers directly and through other headers
+@pytest.fixture
+def program(mbed):
+    popen(['git', 'clone', mkgit('lib'), 'libwork'])
+    write('libwork/other.h', 'int other(void);\n')
+    lib_rev = commit('libwork')
+
+    popen(['git', 'clone', mkgit('prog'), 'prog'])
+    with cd('prog'):
+        popen(['git', 'clone', os.path.abspath('../libwork'), 'lib'])
+    write('prog/lib.lib', os.path.abspath('libwork').replace('\\', '/') + '/#' + lib_rev + '\n')
+    write('prog/.gitignore', 'lib\n')
+    write('prog/util.h', 'int util(void);\n')
+    write('prog/util.cpp', '#include "util.h"\nint util(void) { return 1; }\n')
+    write('prog/wrap.h', '#include "util.h"\n')
+    write('prog/TESTS/a/one/main.cpp', '#include "util.h"\n')
+    write('prog/TESTS/a/two/main.cpp', '#include "other.h"\n')
+    write('prog/TESTS/b/three/main.cpp', '#include "wrap.h"\n')
+    write('prog/TESTS/b/four/main.cpp', 'int main() {}\n')
+    commit('prog')
+    with cd('prog'):
+        popen(['git', 'tag', 'base'])
+
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    return mbed_cli.Program(os.path.abspath('prog'))
+
+def affected(program):
+    with cd(program.path):
+        return program.get_affected_tests([program.path], 'base')
+
+# Tests that a changed header affects the tests that include it directly or through other headers
+def test_affected_header(program):
+    assert affected(program) == set()
+
+    write('prog/util.h', 'int util(void);\nint util2(void);\n')
+    assert affected(program) == set(['tests-a-one', 'tests-b-three'])
+
+# Tests that a library is compared with the revision its .lib file referenced
+def test_affected_lib(program):
+    write('libwork/other.h', 'int other(int);\n')
+    lib_rev = commit('libwork')
+    with cd('prog/lib'):
+        popen(['git', 'pull', 'origin', 'master'])
+    write('prog/lib.lib', os.path.abspath('libwork').replace('\\', '/') + '/#' + lib_rev + '\n')
+
+    assert affected(program) == set(['tests-a-two'])
+
+# Tests that changed sources outside of test directories affect all tests
+def test_affected_all(program):
+    write('prog/TESTS/b/four/main.cpp', 'int main() { return 0; }\n')
+    assert affected(program) == set(['tests-b-four'])
+
+    write('prog/util.cpp', '#include "util.h"\nint util(void) { return 2; }\n')
+    assert affected(program) is None
@@ -0,0 +1,69 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+import imp
+from util import *
+
+# Program with sources, a build profile, build tools and the artifacts of a finished build
+@pytest.fixture
+def build(mbed):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    for d in ['prog/source', 'prog/BUILD/K64F/GCC_ARM', 'tools']:
+        os.makedirs(d)
+    for fl, content in [('prog/.mbed', ''), ('prog/source/main.cpp', 'int main() {}\n'), ('profile.json', '{}\n'),
+                        ('tools/make.py', '# tools\n'), ('prog/BUILD/K64F/GCC_ARM/prog.bin', 'firmware')]:
+        with open(fl, 'w') as f:
+            f.write(content)
+    return mbed_cli, mbed_cli.Program(os.path.abspath('prog'))
+
+def build_key(program, profile='profile.json', env={'MBED_GCC_ARM_PATH': '/gcc'}):
+    return program.get_build_key(program.get_tools_key(os.path.abspath('tools')), 'K64F', 'GCC_ARM', [], [os.path.abspath(profile)],
+                                 [program.path], os.path.join(program.path, 'BUILD', 'K64F', 'GCC_ARM'), None, None, [], env)
+
+# Touches a file so it differs in size and modification time
+def modify(fl):
+    st = os.stat(fl)
+    with open(fl, 'a') as f:
+        f.write('// changed\n')
+    os.utime(fl, (st.st_atime, st.st_mtime + 10))
+
+# Tests that a build is reused until the sources, profile, environment or build tools change
+def test_build_cached(build):
+    mbed_cli, program = build
+    build_path = os.path.join(program.path, 'BUILD', 'K64F', 'GCC_ARM')
+    key = build_key(program)
+    assert not program.is_build_cached(build_path, key)
+
+    program.set_build_cached(build_path, key)
+    assert build_key(program) == key
+    assert program.is_build_cached(build_path, key)
+
+    assert build_key(program, env={'MBED_GCC_ARM_PATH': '/other'}) != key
+    with open('profile2.json', 'w') as f:
+        f.write('{"debug": true}\n')
+    assert build_key(program, profile='profile2.json') != key
+
+    modify(os.path.join('tools', 'make.py'))
+    assert build_key(program) != key
+    key = build_key(program)
+    modify(os.path.join('prog', 'source', 'main.cpp'))
+    assert build_key(program) != key
+
+# Tests that modified artifacts are not reused
+def test_build_cached_artifacts(build):
+    mbed_cli, program = build
+    build_path = os.path.join(program.path, 'BUILD', 'K64F', 'GCC_ARM')
+    key = build_key(program)
+    program.set_build_cached(build_path, key)
+
+    modify(os.path.join(build_path, 'prog.bin'))
+    assert not program.is_build_cached(build_path, key)
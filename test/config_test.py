@@ -0,0 +1,80 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+import imp
+from util import *
+
+# Tests that config files are parsed again when they change outside of mbed CLI
+def test_config_reload(mbed):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    os.mkdir('prog')
+    cfg = mbed_cli.Cfg(os.path.abspath('prog'))
+
+    cfg.set('TARGET', 'K64F')
+    cfg.set('TOOLCHAIN', 'ARM')
+    assert cfg.get('TARGET') == 'K64F'
+    assert cfg.list() == {'TARGET': 'K64F', 'TOOLCHAIN': 'ARM'}
+
+    with open(os.path.join('prog', '.mbed'), 'w') as f:
+        f.write('TARGET=NUCLEO_F401RE\nROOT=.\n')
+    assert cfg.get('TARGET') == 'NUCLEO_F401RE'
+    assert cfg.get('TOOLCHAIN', 'GCC_ARM') == 'GCC_ARM'
+    assert cfg.list() == {'TARGET': 'NUCLEO_F401RE'}
+
+    cfg.set('TARGET', None)
+    assert cfg.get('TARGET') is None
+    assert cfg.get('ROOT') == '.'
+
+# Tests the precedence of program config, environment variables and global config
+def test_config_layers(mbed, monkeypatch):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    os.mkdir('home')
+    monkeypatch.setenv('HOME', os.path.abspath('home'))
+    os.mkdir('prog')
+    with cd('prog'):
+        popen(['python', mbed, 'config', 'root', '.'])
+    program = mbed_cli.Program(os.path.abspath('prog'))
+
+    mbed_cli.Global().set_cfg('TOOLCHAIN', 'ARM')
+    assert program.get_cfg('TOOLCHAIN') == 'ARM'
+
+    monkeypatch.setenv('MBED_TOOLCHAIN', 'IAR')
+    assert program.get_cfg('TOOLCHAIN') == 'IAR'
+
+    program.set_cfg('TOOLCHAIN', 'GCC_ARM')
+    assert program.get_cfg('TOOLCHAIN') == 'GCC_ARM'
+
+    monkeypatch.setenv('MBED_ROOT', 'elsewhere')
+    assert mbed_cli.Global().get_cfg('ROOT') is None
+
+# Tests that duplicate keys resolve like before: the first one for lookups, the last one for listings
+def test_config_duplicates(mbed):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    os.mkdir('prog')
+    with open(os.path.join('prog', '.mbed'), 'w') as f:
+        f.write('TARGET=K64F\nTARGET=NUCLEO_F401RE\n')
+    cfg = mbed_cli.Cfg(os.path.abspath('prog'))
+    assert cfg.get('TARGET') == 'K64F'
+    assert cfg.list() == {'TARGET': 'NUCLEO_F401RE'}
+
+# Tests that the environment layer isn't shown as global config, and is listed on its own
+def test_config_env_output(mbed, monkeypatch):
+    os.mkdir('home')
+    monkeypatch.setenv('HOME', os.path.abspath('home'))
+    popen(['python', mbed, 'config', '-G', 'toolchain', 'ARM'])
+    monkeypatch.setenv('MBED_TOOLCHAIN', 'IAR')
+
+    assert pquery(['python', mbed, 'config', '-G', 'toolchain']).strip() == '[mbed] ARM'
+
+    out = pquery(['python', mbed, 'config', '-L'])
+    env_out = out.split('Environment config:')[1].split('[mbed] Local config')[0]
+    assert 'MBED_TOOLCHAIN=IAR' in env_out
+    assert 'TOOLCHAIN=ARM' in out.split('Environment config:')[0]
@@ -0,0 +1,69 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+import imp
+from util import *
+
+# Fake boards with a directory standing in for the mass storage device of each board
+@pytest.fixture
+def boards(mbed, monkeypatch):
+    os.mkdir('home')
+    monkeypatch.setenv('HOME', os.path.abspath('home'))
+    boards = []
+    for i in range(4):
+        mount = os.path.abspath('mount%d' % i)
+        os.mkdir(mount)
+        boards.append({'id': '0240000%d' % i, 'name': 'K64F', 'mount': mount, 'serial': '/dev/ttyACM%d' % i})
+    with open('firmware.bin', 'w') as f:
+        f.write('firmware')
+    return boards
+
+def fake_flash(mount, fw_file, program_cycle_s=2):
+    if not os.path.isdir(mount):
+        return False
+    shutil.copy(fw_file, mount)
+    return True
+
+def fake_reset(serial):
+    return serial != '/dev/ttyACM3'
+
+# Tests flashing multiple boards concurrently with per board results
+def test_flash_boards(mbed, boards):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    remove(boards[1]['mount'])
+
+    results = mbed_cli.flash_boards(boards, os.path.abspath('firmware.bin'), fake_flash, fake_reset)
+
+    assert [board['id'] for board, _, _ in results] == [board['id'] for board in boards]
+    assert [status for _, status, _ in results] == ['ok', 'flash', 'ok', 'reset']
+    for board in [boards[0], boards[2], boards[3]]:
+        assert os.path.isfile(os.path.join(board['mount'], 'firmware.bin'))
+
+# Tests that boards are only flashed again when the firmware or the board enumeration changed
+def test_flash_boards_unchanged(mbed, boards):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    fw_file = os.path.abspath('firmware.bin')
+
+    results = mbed_cli.flash_boards(boards[:3], fw_file, fake_flash, fake_reset)
+    assert [status for _, status, _ in results] == ['ok', 'ok', 'ok']
+
+    boards[1]['mount'] = os.path.abspath('mount3')
+    results = mbed_cli.flash_boards(boards[:3], fw_file, fake_flash, fake_reset)
+    assert [status for _, status, _ in results] == ['unchanged', 'ok', 'unchanged']
+
+    results = mbed_cli.flash_boards(boards[:3], fw_file, fake_flash, fake_reset, force=True)
+    assert [status for _, status, _ in results] == ['ok', 'ok', 'ok']
+
+    with open('firmware.bin', 'w') as f:
+        f.write('new firmware')
+    results = mbed_cli.flash_boards(boards[:3], fw_file, fake_flash, fake_reset)
+    assert [status for _, status, _ in results] == ['ok', 'ok', 'ok']
@@ -0,0 +1,92 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+import imp
+import sys
+from util import *
+
+# Greentea stand-in that records its arguments and writes a report in which all tests pass
+# except the ones listed in FAIL_TESTS
+MBEDGT = '''#!%s
+import os, sys, json
+with open(os.path.join(os.environ['CALLS_DIR'], 'calls.log'), 'a') as f:
+    f.write(json.dumps(sys.argv[1:]) + '\\n')
+tests = sys.argv[sys.argv.index('-n') + 1].split(',') if '-n' in sys.argv else ['tests-a-one', 'tests-a-two']
+failed = os.environ.get('FAIL_TESTS', '').split(',')
+with open(sys.argv[sys.argv.index('--report-json') + 1], 'w') as f:
+    json.dump({'K64F-GCC_ARM': dict((t, {'single_test_result': 'FAIL' if t in failed else 'OK'}) for t in tests)}, f)
+'''
+
+# Program with built tests, a test spec and greentea on the path
+@pytest.fixture
+def tests(mbed, monkeypatch):
+    os.mkdir('home')
+    monkeypatch.setenv('HOME', os.path.abspath('home'))
+    monkeypatch.setenv('CALLS_DIR', os.getcwd())
+    os.mkdir('bin')
+    with open(os.path.join('bin', 'mbedgt'), 'w') as f:
+        f.write(MBEDGT % sys.executable)
+    os.chmod(os.path.join('bin', 'mbedgt'), 0o755)
+    monkeypatch.setenv('PATH', os.path.abspath('bin') + os.pathsep + os.environ['PATH'])
+
+    os.mkdir('prog')
+    with cd('prog'):
+        open('.mbed', 'w').close()
+        for name in ['one', 'two']:
+            with open(name + '.bin', 'w') as f:
+                f.write(name)
+        with open('test_spec.json', 'w') as f:
+            json.dump({'builds': {'K64F-GCC_ARM': {'tests': {
+                'tests-a-one': {'binaries': [{'path': 'one.bin'}]},
+                'tests-a-two': {'binaries': [{'path': 'two.bin'}]}}}}}, f)
+
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    monkeypatch.setattr(mbed_cli.Program, 'check_requirements', lambda self, *args: None)
+    monkeypatch.setattr(mbed_cli.Program, 'get_tools', lambda self: os.path.abspath('tools'))
+    mbed_cli.remainder = []
+    return mbed_cli
+
+def run_tests(mbed_cli):
+    with cd('prog'):
+        mbed_cli.test_(toolchain='GCC_ARM', target='K64F', run_only=True, test_spec='test_spec.json')
+
+def calls():
+    with open('calls.log') as f:
+        return [json.loads(line) for line in f]
+
+def run_list(call):
+    return call[call.index('-n') + 1].split(',') if '-n' in call else None
+
+# Tests that only passed tests are recorded and skipped until their binaries change
+def test_tests_cached(tests, monkeypatch):
+    monkeypatch.setenv('FAIL_TESTS', 'tests-a-two')
+    run_tests(tests)
+    assert run_list(calls()[-1]) is None
+    assert len(tests.Store('test-results').load()) == 1
+
+    run_tests(tests)
+    assert run_list(calls()[-1]) == ['tests-a-two']
+
+    with open(os.path.join('prog', 'one.bin'), 'w') as f:
+        f.write('rebuilt')
+    run_tests(tests)
+    assert run_list(calls()[-1]) is None # nothing cached, so all tests run
+
+# Tests that greentea isn't started when all tests passed before
+def test_tests_all_cached(tests, capsys):
+    run_tests(tests)
+    assert len(calls()) == 1
+    capsys.readouterr()
+
+    run_tests(tests)
+    assert len(calls()) == 1
+    assert "Nothing to run" in capsys.readouterr()[0]
@@ -0,0 +1,83 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+import imp
+import imp
+import json
+from util import *
+
+supported = """\
++-----------+-----------+-----------+
+| Target    |  ARM      |  GCC_ARM  |
++-----------+-----------+-----------+
+| K64F      | Supported | Supported |
+| NRF51_DK  |     -     | Supported |
++-----------+-----------+-----------+
+Supported targets: 2
+"""
+
+tests = """\
+Test Case:
+    Name: tests-mbed_drivers-ticker
+    Path: ./TESTS/mbed_drivers/ticker
+Test Case:
+    Name: tests-mbed_drivers-timeout
+    Path: ./TESTS/mbed_drivers/timeout
+"""
+
+# Tests that the tables and test lists of the mbed OS tools are parsed into rows
+def test_parse_listing(mbed):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    assert mbed_cli.parse_listing(supported) == [
+        {'Target': 'K64F', 'ARM': 'Supported', 'GCC_ARM': 'Supported'},
+        {'Target': 'NRF51_DK', 'ARM': '-', 'GCC_ARM': 'Supported'}]
+    assert mbed_cli.parse_listing(tests) == [
+        {'name': 'tests-mbed_drivers-ticker', 'path': './TESTS/mbed_drivers/ticker'},
+        {'name': 'tests-mbed_drivers-timeout', 'path': './TESTS/mbed_drivers/timeout'}]
+    assert mbed_cli.parse_listing('') == []
+
+# Tests that listings are replayed from the cache while the command and key are unchanged
+def test_run_listing_cache(mbed, monkeypatch, capsys):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    os.mkdir('home')
+    monkeypatch.setenv('HOME', os.path.abspath('home'))
+    os.mkdir('prog')
+    with cd('prog'):
+        popen(['python', mbed, 'config', 'root', '.'])
+    program = mbed_cli.Program(os.path.abspath('prog'))
+    with open('supported.txt', 'w') as f:
+        f.write(supported)
+
+    # The output of the tools without the mbed CLI messages
+    def output():
+        return ''.join(l for l in capsys.readouterr()[0].splitlines(True) if not l.startswith('[mbed]'))
+
+    started = []
+    pstart = mbed_cli.pstart
+    def counting_pstart(command, **kwargs):
+        started.append(command)
+        return pstart(command, **kwargs)
+    monkeypatch.setattr(mbed_cli, 'pstart', counting_pstart)
+    capsys.readouterr()
+
+    command = ['python', '-c', 'import sys; sys.stdout.write(open("supported.txt").read())', '-S']
+    program.run_listing(command, 'key1', os.environ.copy(), json_output=True)
+    assert len(started) == 1
+    first = output()
+    assert json.loads(first)[0]['Target'] == 'K64F'
+
+    program.run_listing(command, 'key1', os.environ.copy(), json_output=True)
+    assert len(started) == 1
+    assert output() == first
+
+    program.run_listing(command, 'key2', os.environ.copy())
+    assert len(started) == 2
+    assert output() == supported
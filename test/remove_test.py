@@ -10,6 +10,7 @@
 # distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, 
 # either express or implied.
 
+import time
 from util import *
 
 # Tests the result of 'mbed remove'
@@ -32,3 +33,30 @@ def test_import_after_remove(mbed, testrepos):
     assertls(mbed, 'testimport', [
         "testimport",
     ])
+
+# Waits until the trash of a program has been purged in the background
+def assertpurged(dir, timeout=30):
+    deadline = time.time() + timeout
+    while os.path.exists(os.path.join(dir, '.mbed-trash')) and time.time() < deadline:
+        time.sleep(0.1)
+    assert not os.path.exists(os.path.join(dir, '.mbed-trash'))
+
+# Tests that removed libraries are moved to the trash and deleted in the background
+def test_remove_trash(mbed, testrepos):
+    with cd('test1'):
+        popen(['python', mbed, 'remove', 'test2', '--trace', '../trace.json'])
+
+    assert not os.path.exists(os.path.join('test1', 'test2'))
+    assertpurged('test1')
+    with open('trace.json') as f:
+        spawns = [e for e in json.load(f)['traceEvents'] if e.get('cat') == 'spawn']
+    assert [e['args']['command'].split()[3] for e in spawns] == ['purge-trash']
+
+# Tests that a purge interrupted in an earlier command is finished by the next one
+def test_purge_resume(mbed, testrepos):
+    os.makedirs(os.path.join('test1', '.mbed-trash', 'lib.tmp', 'lib'))
+    os.makedirs(os.path.join('test1', '.mbed-trash', '.purge-1-lib2.tmp', 'lib2'))
+    with cd('test1'):
+        popen(['python', mbed, 'sync'])
+
+    assertpurged('test1')
@@ -0,0 +1,60 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+import imp
+import imp
+import sys
+import types
+from util import *
+
+# Tests that checked requirements are cached until requirements.txt changes
+def test_requirements_cache(mbed, monkeypatch):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    os.mkdir('home')
+    monkeypatch.setenv('HOME', os.path.abspath('home'))
+    os.mkdir('prog')
+    with cd('prog'):
+        popen(['python', mbed, 'config', 'root', '.'])
+        with open('requirements.txt', 'w') as f:
+            f.write('foo>=1.0\n')
+    program = mbed_cli.Program(os.path.abspath('prog'))
+
+    # Fake pip that counts the package enumerations and installs
+    installed = ['foo']
+    calls = []
+    class Dist(object):
+        def __init__(self, name):
+            self.project_name = name
+    def get_installed_distributions(local_only=False):
+        calls.append('list')
+        return [Dist(name) for name in installed]
+    def pquery(command, **kwargs):
+        calls.append(command[0])
+        installed.append('bar')
+        return ''
+    pip = types.ModuleType('pip')
+    pip.get_installed_distributions = get_installed_distributions
+    monkeypatch.setitem(sys.modules, 'pip', pip)
+    monkeypatch.setattr(mbed_cli, 'pquery', pquery)
+    monkeypatch.setattr(mbed_cli, 'install_requirements', True)
+
+    program.check_requirements()
+    assert calls == ['list']
+    program.check_requirements()
+    assert calls == ['list']
+
+    # Adding a missing package invalidates the cache and installs it once
+    with open(os.path.join('prog', 'requirements.txt'), 'a') as f:
+        f.write('bar\n')
+    program.check_requirements()
+    assert calls == ['list', 'list', 'pip']
+    program.check_requirements()
+    assert calls == ['list', 'list', 'pip']
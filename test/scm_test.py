@@ -0,0 +1,123 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+import imp
+import json
+from util import *
+
+# Tests that the SCM of local repositories is detected without trying to clone them
+def test_detect_scm(mbed, monkeypatch):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    git_url = mkgit('gitrepo')
+    hg_url = mkhg('hgrepo')
+    os.mkdir('home')
+    monkeypatch.setenv('HOME', os.path.abspath('home'))
+
+    assert mbed_cli.Repo.detect_scm(git_url).name == 'git'
+    assert mbed_cli.Repo.detect_scm(hg_url).name == 'hg'
+    assert mbed_cli.Repo.detect_scm(os.path.abspath('missing')) is None
+    assert mbed_cli.spawned == []
+
+# Tests that the SCM that served a URL is recorded and used for URLs that match more than one SCM
+def test_scm_store(mbed, monkeypatch):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    hg_url = mkhg('hgrepo')
+    os.mkdir('home')
+    monkeypatch.setenv('HOME', os.path.abspath('home'))
+
+    mbed_cli.Repo.fromurl(hg_url).clone(hg_url, 'imported')
+    with open(os.path.join('home', '.mbed', 'scm.json')) as f:
+        known = json.load(f)
+    assert [scm for scm, _ in known.values()] == ['hg']
+
+    url = 'https://example.com/team/project'
+    mbed_cli.Repo.set_scm(url, mbed_cli.scms['hg'])
+    assert mbed_cli.Repo.detect_scm(url + '/').name == 'hg'
+    assert mbed_cli.spawned == ['hg clone']
+
+# Tests that the ref index finds the same branches as "git show-ref", including packed refs
+def test_git_refindex(mbed):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    popen(['git', 'clone', mkgit('gitrepo'), 'clone'])
+    with cd('clone'):
+        popen(['git', 'branch', 'packed'])
+        popen(['git', 'pack-refs', '--all'])
+        popen(['git', 'branch', 'loose'])
+        popen(['git', 'tag', 'v1'])
+        rev = pquery(['git', 'rev-parse', 'HEAD']).strip()
+
+        assert mbed_cli.Git.getrefs(rev) == ['loose', 'master', 'packed', 'origin/HEAD', 'origin/master']
+        assert mbed_cli.Git.getrefs(rev[:7], True) == [rev] * 5
+
+        popen(['git', 'branch', '-D', 'loose'])
+        assert mbed_cli.Git.getrefs(rev) == ['master', 'packed', 'origin/HEAD', 'origin/master']
+        assert mbed_cli.spawned == []
+
+# Tests that the branches of a worktree are found in the repository it belongs to
+def test_git_refindex_worktree(mbed):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    popen(['git', 'clone', mkgit('gitrepo'), 'clone'])
+    with cd('clone'):
+        popen(['git', 'worktree', 'add', '-b', 'work', '../worktree'])
+    with cd('worktree'):
+        rev = pquery(['git', 'rev-parse', 'HEAD']).strip()
+        assert mbed_cli.Git.getrefs(rev) == ['master', 'work', 'origin/HEAD', 'origin/master']
+
+# Tests that refs rewritten in place are noticed even if no directory mtime changes
+def test_git_refindex_rewrite(mbed):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    popen(['git', 'clone', mkgit('gitrepo'), 'clone'])
+    with cd('clone'):
+        rev = pquery(['git', 'rev-parse', 'HEAD']).strip()
+        popen(['git', 'branch', 'other'])
+        popen(['git', 'commit', '--allow-empty', '-m', 'test commit'])
+        new_rev = pquery(['git', 'rev-parse', 'HEAD']).strip()
+        heads = os.path.join('.git', 'refs', 'heads')
+        os.utime(heads, (1000000000, 1000000000))
+        assert mbed_cli.Git.getrefs(rev) == ['other', 'origin/HEAD', 'origin/master']
+
+        with open(os.path.join(heads, 'other'), 'w') as f:
+            f.write(new_rev + '\n')
+        os.utime(heads, (1000000000, 1000000000))
+        assert mbed_cli.Git.getrefs(rev) == ['origin/HEAD', 'origin/master']
+
+# Tests that all local branches are deleted with one process
+def test_git_cleanup(mbed):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    popen(['git', 'clone', mkgit('gitrepo'), 'clone'])
+    with cd('clone'):
+        for i in range(20):
+            popen(['git', 'branch', 'b%d' % i])
+        mbed_cli.Git.cleanup()
+
+        assert pquery(['git', 'for-each-ref', 'refs/heads/']) == ''
+        assert mbed_cli.spawned == ['git checkout', 'git update-ref']
+
+# Tests cloning with the objects of a cached repository instead of copying it
+@pytest.mark.parametrize('reference', ['on', 'off'])
+def test_cache_reference(mbed, monkeypatch, reference):
+    mkgit('gitrepo')
+    os.mkdir('home')
+    monkeypatch.setenv('HOME', os.path.abspath('home'))
+    # The repository cache is only used for URLs with a host
+    url = 'https://example.com/gitrepo.git'
+    popen(['git', 'config', '--global', 'url.%s/.insteadOf' % os.getcwd(), 'https://example.com/'])
+    popen(['python', mbed, 'config', '-G', 'cache', os.path.abspath('cache')])
+    popen(['python', mbed, 'config', '-G', 'cache_reference', reference])
+
+    popen(['python', mbed, 'import', url, 'first'])
+    output = pquery(['python', mbed, 'import', url, 'second', '-v'])
+
+    assert ('with objects from' in output) == (reference == 'on')
+    assert ('Carbon copy' in output) == (reference == 'off')
+    assert not os.path.exists(os.path.join('second', '.git', 'objects', 'info', 'alternates'))
+    with cd('second'):
+        assert pquery(['git', 'for-each-ref', '--format=%(refname)', 'refs/heads/']).split() == ['refs/heads/master']
@@ -0,0 +1,47 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+import imp
+import sys
+from util import *
+
+# Tests splitting tests into groups of similar duration, with the median duration for unknown tests
+def test_shard_tests(mbed):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    durations = {'a': 10.0, 'b': 8.0, 'c': 3.0, 'd': 3.0, 'e': 2.0}
+
+    groups = mbed_cli.shard_tests(['a', 'b', 'c', 'd', 'e', 'f'], durations, 2)
+
+    assert groups == [['a', 'd', 'e'], ['b', 'c', 'f']]
+
+# Tests that no empty groups are created for more boards than tests
+def test_shard_tests_few(mbed):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+
+    assert mbed_cli.shard_tests(['a', 'b'], {}, 4) == [['a'], ['b']]
+
+# Tests that errors in one of the concurrent jobs are returned as its result
+def test_run_parallel_errors(mbed):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    def func(item):
+        if item == 'exit':
+            sys.exit(1)
+        if item == 'raise':
+            raise ValueError(item)
+        return item
+
+    results = mbed_cli.run_parallel(['ok', 'exit', 'raise'], func, 2)
+
+    assert [item for item, _, _ in results] == ['ok', 'exit', 'raise']
+    assert results[0][1] == 'ok'
+    assert isinstance(results[1][1], SystemExit)
+    assert isinstance(results[2][1], ValueError)
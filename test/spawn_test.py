@@ -0,0 +1,46 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+from util import *
+
+# Program with 10 libraries
+@pytest.fixture
+def libtree(mbed):
+    prog = mkgit('prog')
+    popen(['git', 'clone', prog, 'prog'])
+    with cd('prog'):
+        for i in range(10):
+            lib = mkgit('../lib%d' % i)
+            with open('lib%d.lib' % i, 'w') as f:
+                f.write(lib + '/\n')
+        mkcommit(files=['lib%d.lib' % i for i in range(10)])
+        popen(['python', mbed, 'deploy'])
+    return 'prog'
+
+# Tests the number of processes started by commands that walk the tree
+def test_spawns_ls(mbed, libtree):
+    stats = assertspawns(mbed, libtree, ['ls'], 22)
+    assert stats['processes'].get('git fetch', 0) == 0
+
+def test_spawns_status(mbed, libtree):
+    assertspawns(mbed, libtree, ['status'], 33)
+
+# Tests that --profile-cli writes a pstats file with the time spent waiting on child processes
+def test_profile_cli(mbed, libtree):
+    import pstats
+    with cd(libtree):
+        popen(['python', mbed, '--profile-cli=' + os.path.abspath('../ls.prof'), 'ls'])
+
+    stats = pstats.Stats('ls.prof')
+    cc, nc, tt, ct, callers = stats.stats[('~', 0, '<child processes>')]
+    assert cc == nc and cc > 0
+    assert tt == ct and tt > 0
+    assert ('~', 0, '<child processes>') in stats.sort_stats('cumulative').fcn_list
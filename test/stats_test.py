@@ -0,0 +1,86 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+import json
+from util import *
+
+# Tests that commands are recorded in the metrics log and summarized by 'mbed stats'
+def test_stats(mbed, testrepos, monkeypatch):
+    os.mkdir('home')
+    monkeypatch.setenv('HOME', os.path.abspath('home'))
+    popen(['python', mbed, 'config', '-G', 'metrics', 'on'])
+
+    with cd('test1'):
+        popen(['python', mbed, 'ls'])
+        popen(['python', mbed, 'ls'])
+        stats = json.loads(pquery(['python', mbed, 'stats', '--json']))
+
+    assert sorted(stats.keys()) == ['ls']
+    assert stats['ls']['runs'] == 2
+    assert stats['ls']['failed'] == 0
+    assert stats['ls']['duration']['p50'] > 0
+    assert sorted(stats['ls']['libraries'].keys()) == ['.', 'test2', 'test2/test3', 'test2/test3/test4']
+
+# Tests that commands with cache hits and library times are recorded
+def test_stats_cache_hits(mbed, testrepos, monkeypatch):
+    os.mkdir('home')
+    monkeypatch.setenv('HOME', os.path.abspath('home'))
+    popen(['python', mbed, 'config', '-G', 'metrics', 'on'])
+
+    popen(['python', mbed, 'import', testrepos[0], 'testimport1'])
+    popen(['python', mbed, 'import', testrepos[0], 'testimport2'])
+
+    with open(os.path.join('home', '.mbed', 'metrics.jsonl')) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    imports = [r for r in records if r['command'] == 'import']
+    assert len(imports) == 2
+    assert imports[1]['status'] == 0
+    assert imports[1]['cache_hits'].get('scm', 0) > 0
+    assert imports[1]['libraries']
+
+# Tests that the metrics of a command are sent to the configured StatsD server
+def test_stats_statsd(mbed, testrepos, monkeypatch):
+    import socket
+    os.mkdir('home')
+    monkeypatch.setenv('HOME', os.path.abspath('home'))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(10)
+    try:
+        popen(['python', mbed, 'config', '-G', 'metrics', 'on'])
+        popen(['python', mbed, 'config', '-G', 'metrics_statsd', '127.0.0.1:%d' % sock.getsockname()[1]])
+        # Drop the metrics of the config commands
+        sock.settimeout(0.5)
+        try:
+            while True:
+                sock.recv(4096)
+        except socket.timeout:
+            pass
+        sock.settimeout(10)
+
+        with cd('test1'):
+            popen(['python', mbed, 'ls'])
+
+        lines = []
+        try:
+            while True:
+                lines.append(sock.recv(4096))
+                sock.settimeout(0.5)
+        except socket.timeout:
+            pass
+    finally:
+        sock.close()
+
+    assert re.match(r'^mbed\.ls\.duration:\d+\|ms$', lines[0])
+    assert 'mbed.ls.downloaded:0|c' in lines
+    assert 'mbed.ls.status.0:1|c' in lines
+    assert [l for l in lines if re.match(r'^mbed\.ls\.processes:\d+\|c$', l)]
+    assert [l for l in lines if l.startswith('mbed.ls.library.') and l.endswith('|ms')]
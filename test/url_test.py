@@ -0,0 +1,40 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+import imp
+from util import *
+
+# Tests parsing of references and their protocol forms
+def test_parsed_url(mbed):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+
+    url = mbed_cli.ParsedUrl.parse('https://github.com/ARMmbed/mbed-os/#abc123')
+    assert (url.scm, url.host, url.path, url.rev) == ('git', 'github.com', 'ARMmbed/mbed-os', 'abc123')
+    assert mbed_cli.formaturl('git@github.com:ARMmbed/mbed-os.git', 'https') == 'https://github.com/ARMmbed/mbed-os'
+    assert mbed_cli.formaturl('https://github.com/ARMmbed/mbed-os', 'ssh') == 'ssh://git@github.com/ARMmbed/mbed-os.git'
+
+    url = mbed_cli.ParsedUrl.parse('https://mbed.org/users/mbed_official/code/mbed/')
+    assert (url.scm, url.host, url.path) == ('hg', 'mbed.org', 'users/mbed_official/code/mbed')
+    assert url.format('http') == 'http://mbed.org/users/mbed_official/code/mbed'
+    assert mbed_cli.ParsedUrl.parse('https://mbed.org/users/mbed_official/code/mbed/builds/tip').scm == 'bld'
+
+    url = mbed_cli.ParsedUrl.parse('mylib#deadbeef')
+    assert url.local.groups() == ('mylib', 'deadbeef')
+    assert not mbed_cli.Repo.isurl('mylib#deadbeef')
+
+# Tests that the memo of parsed references is bounded and reuses parsed references
+def test_parsed_url_memo(mbed):
+    mbed_cli = imp.load_source('mbed_cli', mbed)
+    first = mbed_cli.ParsedUrl.parse('https://github.com/a/lib0')
+    for i in range(mbed_cli.ParsedUrl.memo_size * 2):
+        assert mbed_cli.ParsedUrl.parse('https://github.com/a/lib%d' % i).path == 'a/lib%d' % i
+        assert mbed_cli.ParsedUrl.parse('https://github.com/a/lib0') is first
+    assert len(mbed_cli.ParsedUrl.memo) == mbed_cli.ParsedUrl.memo_size
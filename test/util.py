@@ -11,6 +11,7 @@
 # either express or implied.
 
 import contextlib
+import json
 import subprocess
 import pytest
 import os
@@ -107,6 +108,18 @@ def assertls(mbed, dir, tree):
     print result
     assert re.match(tree, result, re.MULTILINE)
 
+# Runs an mbed command in dir and asserts that it starts at most limit processes. Returns the spawn statistics
+def assertspawns(mbed, dir, args, limit):
+    stats_file = os.path.abspath('spawn-stats.json')
+    with cd(dir):
+        popen(['python', mbed] + args + ['--spawn-stats', stats_file])
+    with open(stats_file) as f:
+        stats = json.load(f)
+
+    print stats
+    assert stats['total'] <= limit
+    return stats
+
 def scm(dir=None):
     if not dir:
         dir = os.getcwd()
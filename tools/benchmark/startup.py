@@ -0,0 +1,121 @@
+#!/usr/bin/env python2
+
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+# Measures mbed CLI startup cost: module import, argument parsing per command and
+# complete process runs of cheap commands. Results are written as JSON and can be
+# compared against a stored baseline.
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+MBED_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'mbed', 'mbed.py'))
+
+# Executed in a fresh interpreter for every sample so that no module state is shared
+PROBE = """
+import sys, time, imp, json
+t0 = time.time()
+mod = imp.load_source('mbed_cli', sys.argv[1])
+t1 = time.time()
+mod.build_parser(sys.argv[2:])
+mod.parser.parse_known_args(sys.argv[2:])
+t2 = time.time()
+sys.stdout.write(json.dumps({'import': t1 - t0, 'parse': t2 - t1}))
+"""
+
+COMMANDS = [
+    ['config', 'target'],
+    ['ls'],
+    ['update', '--clean'],
+    ['compile', '-m', 'K64F', '-t', 'GCC_ARM'],
+]
+
+EXECS = [
+    ['--version'],
+    ['help'],
+]
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid-1] + values[mid]) / 2.0
+
+def probe(mbed, argv):
+    out = subprocess.check_output([sys.executable, '-c', PROBE, mbed] + argv)
+    return json.loads(out)
+
+def run(mbed, runs):
+    results = {}
+    imports = []
+    for argv in COMMANDS:
+        samples = [probe(mbed, argv) for _ in range(runs)]
+        imports += [s['import'] for s in samples]
+        results['parse:%s' % argv[0]] = median([s['parse'] for s in samples])
+    results['import'] = median(imports)
+
+    with open(os.devnull, 'w') as null:
+        for argv in EXECS:
+            samples = []
+            for _ in range(runs):
+                start = time.time()
+                subprocess.call([sys.executable, mbed] + argv, stdout=null, stderr=null)
+                samples.append(time.time() - start)
+            results['exec:%s' % ' '.join(argv)] = median(samples)
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, value in sorted(results.items()):
+        base = baseline.get(name)
+        if base and value > base * (1 + tolerance):
+            regressions.append((name, base, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mbed CLI startup time')
+    parser.add_argument('--mbed', default=MBED_PATH, help='Path to mbed.py. Default: %(default)s')
+    parser.add_argument('-n', '--runs', type=int, default=5, help='Samples per measurement. Default: %(default)s')
+    parser.add_argument('-o', '--output', help='Write JSON results to this file')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown relative to the baseline. Default: %(default)s')
+    args = parser.parse_args()
+
+    results = run(args.mbed, args.runs)
+    report = {'benchmark': 'startup', 'python': sys.version.split()[0], 'runs': args.runs, 'results': results}
+
+    for name, value in sorted(results.items()):
+        print "%-30s %8.1f ms" % (name, value * 1000)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline.get('results', {}), args.tolerance)
+        for name, base, value in regressions:
+            print "REGRESSION %s: %.1f ms -> %.1f ms" % (name, base * 1000, value * 1000)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python2
+
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+# Measures mbed CLI code management commands on synthetic programs. A program with
+# a dependency tree of configurable breadth and depth is generated from local Git
+# and/or Mercurial repositories, and import, deploy, update, sync, ls, status and
+# publish are timed end to end. Results are written as JSON and can be compared
+# against a stored baseline.
+
+import os
+import sys
+import json
+import stat
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+MBED_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'mbed', 'mbed.py'))
+
+COMMANDS = ['import', 'deploy', 'update', 'sync', 'ls', 'status', 'publish']
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid-1] + values[mid]) / 2.0
+
+def remove(path):
+    def remove_readonly(func, path, _):
+        os.chmod(path, stat.S_IWRITE)
+        func(path)
+
+    shutil.rmtree(path, onerror=remove_readonly)
+
+def call(command, cwd, env):
+    with open(os.devnull, 'w') as null:
+        proc = subprocess.Popen(command, cwd=cwd, env=env, stdout=null, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+    if proc.returncode != 0:
+        raise Exception("\"%s\" in \"%s\" failed:\n%s" % (' '.join(command), cwd, err))
+
+def query(command, cwd, env):
+    return subprocess.check_output(command, cwd=cwd, env=env).strip()
+
+
+# Synthetic dependency trees
+class Tree(object):
+    def __init__(self, root, scm, breadth, depth, files, history):
+        self.root = root
+        self.scm = scm
+        self.breadth = breadth
+        self.depth = depth
+        self.files = files
+        self.history = history
+        self.repos = os.path.join(root, 'repos')
+        self.env = dict(os.environ, HOME=os.path.join(root, 'home'),
+                        GIT_AUTHOR_NAME='mbed', GIT_AUTHOR_EMAIL='mbed@localhost',
+                        GIT_COMMITTER_NAME='mbed', GIT_COMMITTER_EMAIL='mbed@localhost',
+                        HGUSER='mbed <mbed@localhost>')
+        self.count = 0
+        os.makedirs(self.repos)
+        os.makedirs(self.env['HOME'])
+
+    # The SCM of the n-th generated repository
+    def scm_of(self, index):
+        if self.scm == 'mixed':
+            return 'git' if index % 2 == 0 else 'hg'
+        return self.scm
+
+    # Creates a repository with source files, history and .lib references and returns its URL and revision
+    def make_repo(self, name, libs):
+        scm = self.scm_of(self.count)
+        self.count += 1
+        work = os.path.join(self.root, 'work', name)
+        os.makedirs(os.path.join(work, 'source'))
+        call([scm, 'init', '-q'], work, self.env)
+        if scm == 'git':
+            call(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'], work, self.env)
+
+        for i in range(self.files):
+            with open(os.path.join(work, 'source', 'file%d.cpp' % i), 'w') as f:
+                f.write('int %s_file%d(void) { return %d; }\n' % (name, i, i))
+        for lib_name, url, rev in libs:
+            with open(os.path.join(work, lib_name + '.lib'), 'w') as f:
+                f.write('%s/#%s\n' % (url, rev))
+
+        for i in range(self.history):
+            if i > 0:
+                with open(os.path.join(work, 'source', 'file%d.cpp' % (i % self.files if self.files else 0)), 'a') as f:
+                    f.write('// revision %d\n' % i)
+            if scm == 'git':
+                call(['git', 'add', '-A'], work, self.env)
+                call(['git', 'commit', '-q', '--allow-empty', '-m', 'revision %d' % i], work, self.env)
+            else:
+                call(['hg', 'commit', '-q', '-A', '-m', 'revision %d' % i], work, self.env)
+
+        if scm == 'git':
+            url = os.path.join(self.repos, name + '.git')
+            call(['git', 'clone', '-q', '--bare', work, url], self.root, self.env)
+            rev = query(['git', 'rev-parse', 'HEAD'], work, self.env)
+        else:
+            url = os.path.join(self.repos, name)
+            call(['hg', 'clone', '-q', '-U', work, url], self.root, self.env)
+            rev = query(['hg', 'id', '-i', '--debug'], work, self.env)
+        return url.replace('\\', '/'), rev
+
+    # Generates the libraries bottom up and returns the URL of the program
+    def generate(self):
+        def make_libs(prefix, level):
+            libs = []
+            if level > self.depth:
+                return libs
+            for i in range(self.breadth):
+                name = '%s%d' % (prefix, i)
+                url, rev = self.make_repo(name, make_libs(name + '_', level + 1))
+                libs.append((name, url, rev))
+            return libs
+
+        url, _ = self.make_repo('program', make_libs('lib', 1))
+        return url
+
+    # Path from the program root to the first library at the deepest level
+    def leaf_path(self):
+        return ['lib' + '_'.join(['0'] * level) for level in range(1, self.depth + 1)]
+
+
+# Benchmark steps. Every step returns the time of the measured command
+def mbed_cmd(mbed, args):
+    return [sys.executable, mbed] + args
+
+def timed(command, cwd, env):
+    start = time.time()
+    call(command, cwd, env)
+    return time.time() - start
+
+def import_program(mbed, tree, url, dest):
+    return timed(mbed_cmd(mbed, ['import', url, dest]), tree.root, tree.env)
+
+def deploy_program(mbed, tree, url, dest):
+    scm = tree.scm_of(tree.count - 1)
+    call([scm, 'clone', '-q', url, dest], tree.root, tree.env)
+    return timed(mbed_cmd(mbed, ['deploy']), os.path.join(tree.root, dest), tree.env)
+
+def publish_program(mbed, tree, url, dest):
+    import_program(mbed, tree, url, dest)
+    # Libraries are imported at a detached revision, so the modified branch is checked out first
+    path = os.path.join(tree.root, dest)
+    for name in tree.leaf_path():
+        path = os.path.join(path, name)
+        if os.path.isdir(os.path.join(path, '.git')):
+            call(['git', 'checkout', '-q', 'master'], path, tree.env)
+    with open(os.path.join(path, 'source', 'file0.cpp'), 'a') as f:
+        f.write('// published\n')
+    return timed(mbed_cmd(mbed, ['publish', '-M', 'benchmark']), os.path.join(tree.root, dest), tree.env)
+
+def run(mbed, tree, runs, commands):
+    url = tree.generate()
+    results = {}
+
+    samples = dict((cmd, []) for cmd in commands)
+    for i in range(runs):
+        if 'import' in commands:
+            samples['import'].append(import_program(mbed, tree, url, 'import%d' % i))
+        if 'deploy' in commands:
+            samples['deploy'].append(deploy_program(mbed, tree, url, 'deploy%d' % i))
+
+    # Commands that don't change the program share one imported copy
+    shared = [cmd for cmd in ['update', 'sync', 'ls', 'status'] if cmd in commands]
+    if shared:
+        import_program(mbed, tree, url, 'shared')
+        for _ in range(runs):
+            for cmd in shared:
+                samples[cmd].append(timed(mbed_cmd(mbed, [cmd]), os.path.join(tree.root, 'shared'), tree.env))
+
+    if 'publish' in commands:
+        for i in range(runs):
+            samples['publish'].append(publish_program(mbed, tree, url, 'publish%d' % i))
+
+    for cmd in commands:
+        results[cmd] = median(samples[cmd])
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, value in sorted(results.items()):
+        base = baseline.get(name)
+        if base and value > base * (1 + tolerance):
+            regressions.append((name, base, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mbed CLI code management commands on synthetic dependency trees')
+    parser.add_argument('--mbed', default=MBED_PATH, help='Path to mbed.py. Default: %(default)s')
+    parser.add_argument('--scm', choices=['git', 'hg', 'mixed'], default='git', help='Source control of the generated repositories. Default: %(default)s')
+    parser.add_argument('--breadth', type=int, default=3, help='Libraries per program or library. Default: %(default)s')
+    parser.add_argument('--depth', type=int, default=2, help='Levels of nested libraries. Default: %(default)s')
+    parser.add_argument('--files', type=int, default=20, help='Source files per repository. Default: %(default)s')
+    parser.add_argument('--history', type=int, default=10, help='Revisions per repository. Default: %(default)s')
+    parser.add_argument('-c', '--commands', default=','.join(COMMANDS), help='Comma separated commands to measure. Default: %(default)s')
+    parser.add_argument('-n', '--runs', type=int, default=3, help='Samples per measurement. Default: %(default)s')
+    parser.add_argument('-o', '--output', help='Write JSON results to this file')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown relative to the baseline. Default: %(default)s')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated repositories and programs')
+    args = parser.parse_args()
+
+    commands = [c for c in args.commands.split(',') if c]
+    for cmd in commands:
+        if cmd not in COMMANDS:
+            parser.error("unknown command \"%s\". Supported: %s" % (cmd, ', '.join(COMMANDS)))
+
+    root = tempfile.mkdtemp(prefix='mbed-benchmark-')
+    try:
+        tree = Tree(root, args.scm, args.breadth, args.depth, args.files, args.history)
+        results = run(args.mbed, tree, args.runs, commands)
+    finally:
+        if args.keep:
+            print "Generated trees kept in %s" % root
+        else:
+            remove(root)
+
+    params = {'scm': args.scm, 'breadth': args.breadth, 'depth': args.depth, 'files': args.files,
+              'history': args.history, 'libraries': tree.count - 1}
+    report = {'benchmark': 'tree', 'python': sys.version.split()[0], 'runs': args.runs, 'tree': params, 'results': results}
+
+    print "%d libraries (%s, breadth %d, depth %d)" % (params['libraries'], args.scm, args.breadth, args.depth)
+    for name, value in sorted(results.items()):
+        print "%-30s %8.1f ms" % (name, value * 1000)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('tree') != params:
+            print "WARNING: the baseline was measured on a different tree: %s" % json.dumps(baseline.get('tree'), sort_keys=True)
+        regressions = compare(results, baseline.get('results', {}), args.tolerance)
+        for name, base, value in regressions:
+            print "REGRESSION %s: %.1f ms -> %.1f ms" % (name, base * 1000, value * 1000)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()